@@ -0,0 +1,170 @@
+import copy
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class SQLCache:
+    """
+    Bounded LRU of finished SQL texts.
+
+    Identical texts also let asyncpg reuse the statements it has already
+    prepared on the connection (see statement_cache_size in asyncpg).
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, build):
+        try:
+            sql = self._data[key]
+        except KeyError:
+            self.misses += 1
+            sql = self._data[key] = build()
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            return sql
+        self.hits += 1
+        self._data.move_to_end(key)
+        return sql
+
+    def clear(self):
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+        }
+
+    def __repr__(self):
+        return '<SQLCache: {hits} hits, {misses} misses, {size}/{maxsize}>'.format(
+            **self.info()
+        )
+
+
+class CachedRow:
+    """
+    Snapshot of an asyncpg Record for ObjectCache: row[0], row['column'],
+    keys(), values(), items(). List and dict values (arrays, JSON) are
+    copied in and out, so instances built from a cache hit never share
+    them with the cache or with each other.
+    """
+    __slots__ = ('_keys', '_values')
+
+    def __init__(self, keys, values):
+        self._keys = keys
+        self._values = values
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(tuple(record.keys()), _copy_values(record.values()))
+
+    def copy(self):
+        return CachedRow(self._keys, _copy_values(self._values))
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            try:
+                key = self._keys.index(key)
+            except ValueError:
+                raise KeyError(key) from None
+        return self._values[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __len__(self):
+        return len(self._values)
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def keys(self):
+        return iter(self._keys)
+
+    def values(self):
+        return iter(self._values)
+
+    def items(self):
+        return zip(self._keys, self._values)
+
+    def __repr__(self):
+        return '<CachedRow {}>'.format(' '.join(
+            '{}={!r}'.format(k, v) for k, v in self.items()))
+
+
+def _copy_values(values):
+    return tuple(
+        copy.deepcopy(v) if isinstance(v, (list, dict)) else v
+        for v in values
+    )
+
+
+class ObjectCache:
+    """
+    LRU + TTL cache of query results for one model, see LeoORM.cache_model().
+    Any object with the same get/set/clear methods can be used instead.
+    """
+    def __init__(self, maxsize=1000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=MISSING):
+        try:
+            expires, value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = time.monotonic() + self.ttl, value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        if self._data.pop(key, None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        self._data.clear()
+        self.invalidations += 1
+
+    def info(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+        }
+
+    def __repr__(self):
+        return '<ObjectCache: {hits} hits, {misses} misses, {size}/{maxsize}>'.format(
+            **self.info()
+        )
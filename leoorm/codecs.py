@@ -0,0 +1,59 @@
+import json
+from functools import partial
+
+import asyncpg
+
+
+class Connection(asyncpg.Connection):
+    """
+    Connection with the codecs from setup_codecs(). LeoORM sees the flag
+    and leaves JSON encoding and decoding to asyncpg.
+    """
+    __slots__ = ()
+    leoorm_codecs = True
+
+
+def has_codecs(conn):
+    """
+    conn: connection, pool or PoolSet
+    """
+    conn_class = getattr(conn, '_connection_class', None) or conn
+    return getattr(conn_class, 'leoorm_codecs', False)
+
+
+async def setup_codecs(conn, json_dumps=None, json_loads=None):
+    """
+    json/jsonb as Python objects, with any serializer:
+
+        await setup_codecs(conn, json_dumps=orjson.dumps, json_loads=orjson.loads)
+
+    json_dumps may return str or bytes, json_loads gets bytes. The codecs
+    are binary, like the rest of asyncpg's, so COPY keeps working. Other
+    types Django models use already have fitting asyncpg codecs.
+    """
+    json_dumps = json_dumps or partial(json.dumps, ensure_ascii=False)
+    json_loads = json_loads or json.loads
+
+    def encode_json(value):
+        data = json_dumps(value)
+        return data.encode() if isinstance(data, str) else data
+
+    await conn.set_type_codec(
+        'json', encoder=encode_json, decoder=json_loads,
+        schema='pg_catalog', format='binary')
+    # binary jsonb is the json text after a version byte
+    await conn.set_type_codec(
+        'jsonb',
+        encoder=lambda value: b'\x01' + encode_json(value),
+        decoder=lambda data: json_loads(data[1:]),
+        schema='pg_catalog', format='binary')
+
+
+async def prepare_statements(conn, statements):
+    """
+    Prepares statements once on a new connection: SQL errors show up at
+    startup, and non-builtin types they use (enums, domains, extension
+    types) are introspected then instead of on the first real query.
+    """
+    for sql in statements:
+        await conn.prepare(sql)
@@ -1,37 +1,176 @@
+import array
 import asyncio
+import base64
+import copy
 import json
 import logging
 from collections import namedtuple, defaultdict
-from functools import lru_cache
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from functools import lru_cache, partial
 from itertools import chain
+from numbers import Number
 
 import django.apps
-from django.contrib.postgres.fields import JSONField
-from django.db.models import FileField, OneToOneRel
+from django.contrib.postgres.fields import ArrayField, JSONField
+from django.db import connection
+from django.db.models import AutoField, FileField, OneToOneRel, QuerySet
 from django.db.models.base import ModelState
 from django.utils.itercompat import is_iterable
 from django.utils.timezone import now
 
+from . import lookups
+from .cache import MISSING, CachedRow, ObjectCache, SQLCache
+from .codecs import has_codecs
 from .debug import Measure, FromLine, LazyStr
+from .metrics import count_rows
 
 logger = logging.getLogger('leoorm')
 
+# per task: pool -> connection of the enclosing orm.atomic()
+_transactions = ContextVar('leoorm_transactions', default=None)
+# per task: LeoORM -> queue of the enclosing orm.batch()
+_batches = ContextVar('leoorm_batches', default=None)
+
 
 class LeoORM:
-    def __init__(self, conn):
+    # shared by all instances: LeoORM objects usually live for one request
+    sql_cache = SQLCache()
+    # model_class -> ObjectCache, see cache_model()
+    object_caches = {}
+    invalidation_channel = 'leoorm_invalidate'
+
+    def __init__(self, conn, identity_map=False, pool=None, concurrency=4):
+        """
+        conn: asyncpg connection, pool or leoorm.routing.PoolSet
+        identity_map: keep one instance per (model, pk) for the lifetime of
+            this object; get() by pk and prefetch() look there first
+        pool: lets independent reads, like prefetch() of several fields, run
+            on separate connections, at most `concurrency` at once. They do
+            not see uncommitted changes made through conn.
+        """
         self.conn = conn
+        # json/jsonb codecs on the connection, see leoorm.utils.create_db_pool()
+        self.codecs = has_codecs(conn)
         self.i = 0
+        self.identity_map = {} if identity_map else None
+        self.pool = pool
+        self.concurrency = concurrency
+        # orm.load(): (model, field, value) -> future, (model, field) -> {value: future}
+        self._load_futures = {}
+        self._load_batches = {}
+        self._load_lock = None
+
+    @property
+    def conn(self):
+        transactions = _transactions.get()
+        if transactions:
+            return transactions.get(self._conn, self._conn)
+        return self._conn
+
+    @conn.setter
+    def conn(self, conn):
+        self._conn = conn
+
+    @property
+    def read_conn(self):
+        # PoolSet sends reads to replicas
+        return getattr(self.conn, 'reader', self.conn)
+
+    @asynccontextmanager
+    async def atomic(self):
+        """
+        async with orm.atomic():
+            await orm.save(...)
+            async with orm.atomic():  # savepoint
+                ...
+
+        With a pool one connection is held for the whole block. It is used
+        by this task and the tasks it starts; other coroutines sharing the
+        orm object keep using the pool.
+        """
+        conn = self.conn
+        if not hasattr(conn, 'acquire'):
+            async with conn.transaction():
+                yield
+            return
+        async with conn.acquire() as tx_conn:
+            token = _transactions.set({**(_transactions.get() or {}), conn: tx_conn})
+            try:
+                async with tx_conn.transaction():
+                    yield
+            finally:
+                _transactions.reset(token)
+
+    @asynccontextmanager
+    async def batch(self):
+        """
+        async with orm.batch():
+            for obj in objects:
+                await orm.save(obj, status='done')
+                await orm.delete(other_obj)
+
+        Updates and deletes are queued and sent at the end of the block in
+        the order they were made, all in one transaction. Consecutive
+        calls with the same statement go as one executemany(). Inserts still run at once. Queued changes
+        are not visible to reads inside the block.
+        """
+        if self._batch is not None:
+            yield
+            return
+        batch = []
+        token = _batches.set({**(_batches.get() or {}), self: batch})
+        try:
+            yield
+        finally:
+            _batches.reset(token)
+        if batch:
+            await self._flush(batch)
+
+    @property
+    def _batch(self):
+        # [(sql, name, model_class, [args], [instance]), ...]
+        batches = _batches.get()
+        return batches.get(self) if batches else None
+
+    def _queue(self, sql, name, model_class, args, instance=None):
+        batch = self._batch
+        if not batch or batch[-1][0] != sql:
+            batch.append((sql, name, model_class, [], []))
+        item = batch[-1]
+        item[3].append(args)
+        if instance is not None:
+            item[4].append(instance)
+
+    async def _flush(self, batch):
+        async with self.atomic():
+            for sql, name, model_class, args, instances in batch:
+                coro = self.conn.executemany(sql, args)
+                await self._exec(coro, name, sql)
+                await self._invalidate(model_class)
+                if instances:
+                    await self._call_post_save(model_class, instances, False)
 
     async def save(self, instance_or_list, **update_fields):
         """
         await orm.save(instance) -> instance
         await orm.save(instances) -> None
         await orm.save(instance, field1=value, field2=value, ...) -> instance
+
+        Already saved instances in a list are written with orm.update().
         """
         if not instance_or_list:
             return []
         if is_iterable(instance_or_list):
-            return await self._save_bulk(instance_or_list)
+            assert not update_fields
+            lst = list(instance_or_list)
+            pk = self.pk(lst[0].__class__)
+            saved = [obj for obj in lst if getattr(obj, pk)]
+            if not saved:
+                return await self._save_bulk(lst)
+            await self.update(saved)
+            await self._save_bulk([obj for obj in lst if not getattr(obj, pk)])
+            return lst
         instance = instance_or_list
         model_class = instance.__class__
         if getattr(instance, self.pk(model_class)):
@@ -39,6 +178,12 @@ class LeoORM:
         assert not update_fields
         return await self._save_bulk([instance])
 
+    # PostgreSQL refuses statements with more bind parameters than this
+    max_query_args = 32767
+    # lists at least this long go through COPY instead of INSERT
+    copy_threshold = 5000
+    copy_chunk_size = 50000
+
     async def _save_bulk(self, instances):
         if not instances:
             return
@@ -46,115 +191,879 @@ class LeoORM:
         model_class = first_obj.__class__
         pk = self.pk(model_class)
         assert not any(getattr(obj, pk) for obj in instances)
-        names, values = self._names_values(instances)
-        num_names = len(names)
         num_instances = len(instances)
-        sql = (
-            'INSERT INTO {db_table} ({names}) '
-            'VALUES {values} '
-            'RETURNING {pk}'
-        ).format(
-            db_table=self.db_table(model_class),
-            pk=pk,
-            names=', '.join(names),
-            values=', '.join('({})'.format(
-                ', '.join('${}'.format(num_names * j + i + 1) for i in range(num_names))
-            ) for j in range(num_instances)),
-        )
+        if (
+            num_instances >= self.copy_threshold and
+            isinstance(model_class._meta.pk, AutoField)
+        ):
+            return await self._save_copy(instances)
+        names, values = self._names_values(instances)
         if num_instances == 1:
+            sql = self._sql(
+                ('insert', model_class, tuple(names), 1),
+                lambda: self._insert_sql(model_class, names, 1),
+            )
             args = values[0]
             coro = self.conn.fetchval(sql, *args)
             val = await self._exec(coro, 'leoorm._save_one', sql, args)
             first_obj.pk = val
             setattr(first_obj, pk, val)
+            self._merge([first_obj])
+            await self._invalidate(model_class)
             await self._call_post_save(model_class, [first_obj], True)
             return first_obj
-        else:
-            coro = self.conn.fetch(sql, *chain(*values))
+        chunk_size = self.max_query_args // len(names)
+        for start in range(0, num_instances, chunk_size):
+            chunk = values[start:start + chunk_size]
+            sql = self._sql(
+                ('insert', model_class, tuple(names), len(chunk)),
+                lambda: self._insert_sql(model_class, names, len(chunk)),
+            )
+            coro = self.conn.fetch(sql, *chain(*chunk))
             pks = await self._exec(coro, 'leoorm._save_many', sql)
-            for obj, (val,) in zip(instances, pks):
+            for obj, (val,) in zip(instances[start:start + chunk_size], pks):
                 obj.pk = val
                 setattr(obj, pk, val)
-            await self._call_post_save(model_class, instances, True)
-            return instances
+        self._merge(instances)
+        await self._invalidate(model_class)
+        await self._call_post_save(model_class, instances, True)
+        return instances
+
+    async def _save_copy(self, instances):
+        """
+        Binary COPY for big lists: primary keys are taken from the sequence
+        beforehand, so they are known without RETURNING.
+        """
+        model_class = instances[0].__class__
+        pk = self.pk(model_class)
+        pk_column = model_class._meta.pk.column
+        db_table = self.db_table(model_class)
+        nextval_sql = (
+            'SELECT nextval(pg_get_serial_sequence($1, $2)) '
+            'FROM generate_series(1, $3)'
+        )
+        for start in range(0, len(instances), self.copy_chunk_size):
+            chunk = instances[start:start + self.copy_chunk_size]
+            names, values = self._names_values(chunk)
+            args = [db_table, pk_column, len(chunk)]
+            coro = self.conn.fetch(nextval_sql, *args)
+            pks = await self._exec(coro, 'leoorm._save_copy', nextval_sql, args)
+            coro = self.conn.copy_records_to_table(
+                db_table,
+                columns=[pk_column] + names,
+                records=[
+                    [val] + row for (val,), row in zip(pks, values)
+                ],
+            )
+            await self._exec(coro, 'leoorm._save_copy', 'COPY {} ({})'.format(
+                db_table,
+                ', '.join([pk_column] + names),
+            ))
+            for obj, (val,) in zip(chunk, pks):
+                obj.pk = val
+                setattr(obj, pk, val)
+        self._merge(instances)
+        await self._invalidate(model_class)
+        await self._call_post_save(model_class, instances, True)
+        return instances
+
+    async def upsert(self, instances, conflict, update=()):
+        """
+        await orm.upsert([instance, ...], conflict=('field', ...), update=('field', ...))
+            -> [(instance, created), ...]
+
+        INSERT ... ON CONFLICT DO UPDATE, one statement per chunk. Conflicting
+        rows get the fields from `update` overwritten; pk is set on every
+        instance. The same conflict key must not repeat within one call.
+        """
+        instances = list(instances)
+        if not instances:
+            return []
+        model_class = instances[0].__class__
+        pk = self.pk(model_class)
+        fields = {f.name: f for f in self._fields(model_class)}
+        fields.update({f.attname: f for f in self._fields(model_class)})
+        conflict_columns = [fields[k].column for k in conflict]
+        # a no-op assignment still makes RETURNING report conflicting rows
+        update_columns = [fields[k].column for k in update] or conflict_columns[:1]
+        on_conflict = 'ON CONFLICT ({}) DO UPDATE SET {} '.format(
+            ', '.join(conflict_columns),
+            ', '.join('{k} = EXCLUDED.{k}'.format(k=k) for k in update_columns),
+        )
+        names, values = self._names_values(instances)
+        chunk_size = self.max_query_args // len(names)
+        result = []
+        for start in range(0, len(instances), chunk_size):
+            chunk = values[start:start + chunk_size]
+            sql = self._sql(
+                ('upsert', model_class, tuple(names), len(chunk), on_conflict),
+                lambda: self._insert_sql(
+                    model_class,
+                    names,
+                    len(chunk),
+                    on_conflict=on_conflict,
+                    returning='{}, xmax = 0'.format(pk),
+                ),
+            )
+            coro = self.conn.fetch(sql, *chain(*chunk))
+            rows = await self._exec(coro, 'leoorm.upsert', sql)
+            for obj, (val, created) in zip(instances[start:start + chunk_size], rows):
+                obj.pk = val
+                setattr(obj, pk, val)
+                result.append((obj, created))
+        self._merge([obj for obj, created in result])
+        await self._invalidate(model_class)
+        await self._call_post_save(
+            model_class, [obj for obj, created in result if created], True)
+        await self._call_post_save(
+            model_class, [obj for obj, created in result if not created], False)
+        return result
+
+    @classmethod
+    def _insert_sql(cls, model_class, names, num_instances, on_conflict='', returning=None):
+        num_names = len(names)
+        return (
+            'INSERT INTO {db_table} ({names}) '
+            'VALUES {values} '
+            '{on_conflict}'
+            'RETURNING {returning}'
+        ).format(
+            db_table=cls.db_table(model_class),
+            on_conflict=on_conflict,
+            returning=returning or cls.pk(model_class),
+            names=', '.join(names),
+            values=', '.join('({})'.format(
+                ', '.join('${}'.format(num_names * j + i + 1) for i in range(num_names))
+            ) for j in range(num_instances)),
+        )
+
+    @classmethod
+    def cache_model(cls, model_class, cache=None, **kwargs):
+        """
+        LeoORM.cache_model(model_class, maxsize=1000, ttl=60)
+        LeoORM.cache_model(model_class, cache=ObjectCache-like object)
+
+        get(), get_list() with field lookups and prefetch() of the model are
+        then served from process memory. Writes made through LeoORM clear the
+        cache and notify other processes, see listen_invalidations().
+        """
+        cache = cls.object_caches[model_class] = cache or ObjectCache(**kwargs)
+        return cache
+
+    @classmethod
+    async def listen_invalidations(cls, conn):
+        """
+        callback = await LeoORM.listen_invalidations(conn)
+
+        conn must be a dedicated connection that stays open; the returned
+        callback can be passed to conn.remove_listener().
+        """
+        def callback(conn, pid, channel, payload):
+            try:
+                model_class = django.apps.apps.get_model(payload)
+            except (LookupError, ValueError):
+                return
+            cache = cls.object_caches.get(model_class)
+            if cache is not None:
+                cache.clear()
+
+        await conn.add_listener(cls.invalidation_channel, callback)
+        return callback
+
+    async def _invalidate(self, model_class):
+        cache = self.object_caches.get(model_class)
+        if cache is None:
+            return
+        cache.clear()
+        sql = 'SELECT pg_notify($1, $2)'
+        args = [self.invalidation_channel, model_class._meta.label]
+        coro = self.conn.fetchval(sql, *args)
+        await self._exec(coro, 'leoorm._invalidate', sql, args)
+
+    async def _fetch_cached(self, model_class, method, name, sql, values):
+        cache = self.object_caches.get(model_class)
+        key = None
+        if cache is not None:
+            key = (sql, tuple(tuple(v) if isinstance(v, list) else v for v in values))
+            try:
+                hash(key)
+            except TypeError:
+                key = None
+            else:
+                res = cache.get(key)
+                if res is not MISSING:
+                    return self._thaw(res)
+        coro = getattr(self.read_conn, method)(sql, *values)
+        res = await self._exec(coro, name, sql, values)
+        if key is not None:
+            cache.set(key, self._freeze(res))
+        return res
+
+    @staticmethod
+    def _freeze(res):
+        # fetch() -> list of records, fetchrow() -> record or None
+        if res is None:
+            return None
+        if isinstance(res, list):
+            return tuple(CachedRow.from_record(row) for row in res)
+        return CachedRow.from_record(res)
+
+    @staticmethod
+    def _thaw(res):
+        if res is None:
+            return None
+        if isinstance(res, tuple):
+            return [row.copy() for row in res]
+        return res.copy()
 
     async def _call_post_save(self, model_class, objects, is_new):
+        """
+        Model hooks, if defined:
+
+            @classmethod
+            async def async_post_save_bulk(cls, orm, objects, is_new): ...
+
+            async def async_post_save(self, orm, is_new): ...
+
+        The bulk one gets the whole list, never an empty one. Per-object
+        hooks run on self.concurrency workers when conn is a pool, one
+        after another on a single connection, where their queries could
+        not overlap. When a hook raises, the other workers are cancelled.
+        """
+        if not objects:
+            return
+        bulk = getattr(model_class, 'async_post_save_bulk', None)
+        if bulk is not None:
+            await bulk(self, objects, is_new)
+            return
         if not hasattr(model_class, 'async_post_save'):
             return
-        for obj in objects:
-            await obj.async_post_save(self, is_new)
+        objects = iter(objects)
+
+        async def worker():
+            for obj in objects:
+                await obj.async_post_save(self, is_new)
+
+        if not hasattr(self.conn, 'acquire'):
+            await worker()
+            return
+        tasks = [asyncio.ensure_future(worker()) for _ in range(self.concurrency)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
 
     async def _update(self, instance, update_fields):
         model_class = instance.__class__
         names, values = self._names_values([instance], update_fields)
-        sql = 'UPDATE {db_table} SET {values} WHERE {pk} = $1'.format(
-            db_table=self.db_table(model_class),
-            pk=self.pk(model_class),
-            values=', '.join('{k} = ${i}'.format(
-                k=k,
-                i=i + 2,
-            ) for i, k in enumerate(names)),
+        sql = self._sql(
+            ('update', model_class, tuple(names)),
+            lambda: self._update_sql(model_class, names),
         )
         args = [instance.pk] + values[0]
+        if self._batch is not None:
+            self._queue(sql, 'leoorm._update', model_class, args, instance)
+            return instance
         coro = self.conn.execute(sql, *args)
         await self._exec(coro, 'leoorm._update', sql, args)
+        await self._invalidate(model_class)
         await self._call_post_save(model_class, [instance], False)
         return instance
 
-    async def get(self, model_class, *args, **kwargs):
+    async def update(self, instances, *fields):
+        """
+        await orm.update([instance, instance, ...]) -> [instance]
+        await orm.update([instance, instance, ...], 'field1', 'field2', ...) -> [instance]
+
+        One UPDATE ... FROM unnest(...) statement for the whole list.
+        """
+        instances = list(instances)
+        if not instances:
+            return []
+        model_class = instances[0].__class__
+        pk_field = model_class._meta.pk
+        assert all(getattr(obj, pk_field.attname) for obj in instances)
+        names, values = self._names_values(instances, only=fields)
+        columns = {f.column: f for f in self._fields(model_class)}
+        if any(isinstance(columns[k], ArrayField) for k in names):
+            # unnest() flattens nested arrays, so send row by row instead
+            sql = self._sql(
+                ('update', model_class, tuple(names)),
+                lambda: self._update_sql(model_class, names),
+            )
+            args = [
+                [getattr(obj, pk_field.attname)] + row
+                for obj, row in zip(instances, values)
+            ]
+            coro = self.conn.executemany(sql, args)
+            await self._exec(coro, 'leoorm.update', sql)
+        else:
+            sql = self._sql(('update_many', model_class, tuple(names)), lambda: (
+                'UPDATE {db_table} SET {values} '
+                'FROM unnest({arrays}) AS v({pk}, {names}) '
+                'WHERE {db_table}.{pk} = v.{pk}'
+            ).format(
+                db_table=self.db_table(model_class),
+                pk=pk_field.column,
+                names=', '.join(names),
+                values=', '.join('{k} = v.{k}'.format(k=k) for k in names),
+                arrays=', '.join(
+                    '${}::{}[]'.format(i + 1, f.cast_db_type(connection))
+                    for i, f in enumerate(
+                        [pk_field] + [columns[k] for k in names]
+                    )
+                ),
+            ))
+            args = [[getattr(obj, pk_field.attname) for obj in instances]]
+            args += [list(column) for column in zip(*values)]
+            coro = self.conn.execute(sql, *args)
+            await self._exec(coro, 'leoorm.update', sql)
+        await self._invalidate(model_class)
+        await self._call_post_save(model_class, instances, False)
+        return instances
+
+    @classmethod
+    def _update_sql(cls, model_class, names):
+        return 'UPDATE {db_table} SET {values} WHERE {pk} = $1'.format(
+            db_table=cls.db_table(model_class),
+            pk=cls.pk(model_class),
+            values=', '.join('{k} = ${i}'.format(
+                k=k,
+                i=i + 2,
+            ) for i, k in enumerate(names)),
+        )
+
+    async def get(self, model_class, *args, only=None, defer=None, order_by=(), **kwargs):
         """
         await orm.get(model_class, field1=value, field2=value, ...) -> instance or None
         await orm.get(model_class, SQL, arg1, arg2, ...) -> instance or None
+        await orm.get(model_class, only=['field', ...], order_by=['-field', ...], ...)
         """
         if kwargs:
             assert not args
-            cond, values = self._and(kwargs)
-            sql = 'SELECT * FROM {db_table} WHERE {cond}'.format(
-                db_table=self.db_table(model_class),
-                cond=cond,
+            if self.identity_map is not None and len(kwargs) == 1:
+                (k, v), = kwargs.items()
+                pk = model_class._meta.pk
+                if k in ('pk', pk.name, pk.attname, pk.column):
+                    instance = self.identity_map.get((model_class, v))
+                    if instance is not None:
+                        return instance
+            sql, values = self._select_sql(
+                model_class, (), kwargs,
+                only=only, defer=defer, order_by=order_by, limit=1,
             )
+            data = await self._fetch_cached(
+                model_class, 'fetchrow', 'leoorm.get', sql, values)
         elif args:
             values = list(args)
             sql = self._replace_tables(values.pop(0))
+            coro = self.read_conn.fetchrow(sql, *values)
+            data = await self._exec(coro, 'leoorm.get', sql, values)
         else:
             assert False
-        coro = self.conn.fetchrow(sql, *values)
-        data = await self._exec(coro, 'leoorm.get', sql, values)
-        return self.to_model(model_class, data) if data else None
+        if not data:
+            return None
+        instance = self._loader(
+            model_class, data,
+            deferred=bool(only or defer),
+            json_decoded=self.codecs,
+        )(data)
+        if only or defer:
+            return instance
+        return self._merge([instance])[0]
 
-    async def get_list(self, model_class, *args, **kwargs):
+    async def get_list(self, model_class, *args, only=None, defer=None, order_by=None,
+                       limit=None, offset=None, **kwargs):
         """
         await orm.get_list(model_class, field1=value, field2=value, ...) -> [instance]
         await orm.get_list(model_class, SQL, arg1, arg2, ...) -> [instance]
+        await orm.get_list(model_class, only=['field', ...], order_by=['-field', ...],
+                           limit=10, offset=20, ...) -> [instance]
+
+        Fields left out by only/defer are deferred, as in QuerySet.only().
         """
+        sql, values = self._select_sql(
+            model_class, args, kwargs,
+            only=only, defer=defer, order_by=order_by, limit=limit, offset=offset,
+        )
         if args:
-            values = list(args)
-            sql = self._replace_tables(values.pop(0))
+            coro = self.read_conn.fetch(sql, *values)
+            res = await self._exec(coro, 'leoorm.get_list', sql, values)
         else:
-            cond, values = self._and(kwargs)
-            sql = 'SELECT * FROM {db_table} {maybecond} {maybeordering}'.format(
-                db_table=self.db_table(model_class),
-                maybecond='WHERE {}'.format(cond) if cond else '',
-                maybeordering='ORDER BY {}'.format(', '.join(
-                    '{} DESC'.format(f[1:]) if f.startswith('-') else f
-                    for f in model_class._meta.ordering)
-                ) if model_class._meta.ordering else '',
+            res = await self._fetch_cached(
+                model_class, 'fetch', 'leoorm.get_list', sql, values)
+        if not res:
+            return []
+        load = self._loader(
+            model_class, res[0],
+            deferred=bool(only or defer),
+            json_decoded=self.codecs,
+        )
+        if only or defer:
+            return [load(d) for d in res]
+        return self._merge([load(d) for d in res])
+
+    async def values(self, model_class, *fields, order_by=None, limit=None, offset=None,
+                     **kwargs):
+        """
+        await orm.values(model_class, 'field1', 'field2', field3=value, ...)
+            -> [{'field1': ..., 'field2': ...}]
+
+        All fields when none are given. No model instances are created.
+        """
+        names, rows = await self._values(model_class, fields, order_by, limit, offset, kwargs)
+        return [dict(zip(names, row)) for row in rows]
+
+    async def values_list(self, model_class, *fields, flat=False, order_by=None, limit=None,
+                          offset=None, **kwargs):
+        """
+        await orm.values_list(model_class, 'field1', 'field2', field3=value, ...)
+            -> [(value1, value2)]
+        await orm.values_list(model_class, 'field', flat=True, ...) -> [value]
+        """
+        names, rows = await self._values(model_class, fields, order_by, limit, offset, kwargs)
+        if flat:
+            assert len(names) == 1, 'flat=True needs exactly one field'
+            return [row[0] for row in rows]
+        return [tuple(row) for row in rows]
+
+    async def columns(self, model_class, *fields, order_by=None, limit=None, offset=None,
+                      **kwargs):
+        """
+        await orm.columns(model_class, 'field1', 'field2', field3=value, ...)
+            -> {'field1': array, 'field2': array}
+
+        Integer, float and boolean columns without NULLs become numpy
+        arrays, or array.array without numpy; the rest are numpy object
+        arrays or lists.
+        """
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        names, rows = await self._values(model_class, fields, order_by, limit, offset, kwargs)
+        result = {}
+        for i, name in enumerate(names):
+            column = [row[i] for row in rows]
+            typecode = self._array_typecode(self._field(model_class, name))
+            if typecode and None in column:
+                typecode = None
+            if numpy is not None and typecode:
+                result[name] = numpy.array(column, dtype=self._dtypes[typecode])
+            elif numpy is not None:
+                # numpy.array() would turn equal-length lists into a 2-D array
+                result[name] = numpy.empty(len(column), dtype=object)
+                result[name][:] = column
+            elif typecode:
+                result[name] = array.array(typecode, column)
+            else:
+                result[name] = column
+        return result
+
+    _typecodes = {
+        'AutoField': 'q',
+        'BigAutoField': 'q',
+        'SmallAutoField': 'q',
+        'IntegerField': 'q',
+        'BigIntegerField': 'q',
+        'SmallIntegerField': 'q',
+        'PositiveIntegerField': 'q',
+        'PositiveBigIntegerField': 'q',
+        'PositiveSmallIntegerField': 'q',
+        'FloatField': 'd',
+        'BooleanField': 'b',
+    }
+    # array.array typecode -> numpy dtype
+    _dtypes = {'q': 'int64', 'd': 'float64', 'b': 'bool'}
+
+    @classmethod
+    def _array_typecode(cls, f):
+        if f.is_relation:
+            f = f.target_field
+        return cls._typecodes.get(f.get_internal_type())
+
+    async def _values(self, model_class, fields, order_by, limit, offset, kwargs):
+        if not fields:
+            fields = [f.attname for f in self._fields(model_class)]
+        by_name = {name: self._field(model_class, name) for name in fields}
+        unknown = [name for name, f in by_name.items() if f is None]
+        if unknown:
+            raise ValueError('Incorrect fields: {}. Allowed: {}'.format(
+                unknown,
+                ', '.join(f.name for f in self._fields(model_class))
+            ))
+        sql, values = self._select_sql(
+            model_class, (), kwargs,
+            order_by=order_by, limit=limit, offset=offset,
+            columns=tuple(by_name[name].column for name in fields),
+        )
+        rows = await self._fetch_cached(
+            model_class, 'fetch', 'leoorm.values', sql, values)
+        json_indexes = [] if self.codecs else [
+            i for i, name in enumerate(fields)
+            if isinstance(by_name[name], JSONField)
+        ]
+        if json_indexes:
+            rows = [list(row) for row in rows]
+            for row in rows:
+                for i in json_indexes:
+                    if isinstance(row[i], str):
+                        row[i] = json.loads(row[i])
+        return fields, rows
+
+    async def iterate(self, model_class, *args, batch_size=None, fetch_size=1000, prefetch=(), **kwargs):
+        """
+        async for instance in orm.iterate(model_class, field1=value, field2=value, ...)
+        async for instance in orm.iterate(model_class, SQL, arg1, arg2, ...)
+        async for instances in orm.iterate(model_class, ..., batch_size=1000)
+
+        Rows are read through a server-side cursor, fetch_size at a time;
+        `prefetch` fields are loaded with orm.prefetch() for every batch.
+        With a pool one connection is held until the iteration ends. After a
+        break the cursor's transaction stays open until the generator is
+        closed, so close it explicitly:
+
+            async with contextlib.aclosing(orm.iterate(...)) as instances:
+                async for instance in instances:
+                    ...
+        """
+        sql, values = self._select_sql(model_class, args, kwargs)
+        name = 'leoorm.iterate'
+        async for rows in self._fetch_batches(name, sql, values, batch_size or fetch_size):
+            load = self._loader(model_class, rows[0], json_decoded=self.codecs)
+            instances = self._merge([load(d) for d in rows])
+            if prefetch:
+                await self.prefetch(instances, *prefetch)
+            if batch_size:
+                yield instances
+            else:
+                for instance in instances:
+                    yield instance
+
+    async def iterate_raw(self, sql, *values, batch_size=None, fetch_size=1000):
+        """
+        async for record in orm.iterate_raw(SQL, arg1, arg2, ...)
+        async for records in orm.iterate_raw(SQL, arg1, arg2, ..., batch_size=1000)
+
+        See iterate() about breaking out of the loop.
+        """
+        sql = self._replace_tables(sql)
+        name = 'leoorm.iterate_raw'
+        async for rows in self._fetch_batches(name, sql, values, batch_size or fetch_size):
+            if batch_size:
+                yield rows
+            else:
+                for row in rows:
+                    yield row
+
+    async def _fetch_batches(self, name, sql, values, size):
+        conn = self.read_conn
+        # leoorm.routing.Replica wraps a pool
+        pool = getattr(conn, 'pool', conn)
+        if hasattr(pool, 'acquire'):
+            async with pool.acquire() as conn:
+                async for rows in self._fetch_cursor(conn, name, sql, values, size):
+                    yield rows
+        else:
+            async for rows in self._fetch_cursor(conn, name, sql, values, size):
+                yield rows
+
+    async def _fetch_cursor(self, conn, name, sql, values, size):
+        # cursors only live inside a transaction
+        async with conn.transaction():
+            cursor = await self._exec(conn.cursor(sql, *values), name, sql, values)
+            while True:
+                rows = await self._exec(cursor.fetch(size), name, sql)
+                if not rows:
+                    break
+                yield rows
+                if len(rows) < size:
+                    break
+
+    async def get_page(self, model_class, cursor=None, limit=20, order_by=None, **kwargs):
+        """
+        instances, cursor = await orm.get_page(model_class, field1=value, ..., limit=20)
+        instances, cursor = await orm.get_page(model_class, cursor=cursor, field1=value, ...)
+
+        Keyset pagination: the cursor keeps the sort key of the last row and
+        the next page starts with WHERE (a, b) > (...), so deep pages cost
+        the same as the first one. The primary key is added to the ordering
+        as a tie-breaker; sort fields are expected to be NOT NULL. The
+        returned cursor is None on the last page; it only fits the same
+        order_by, anything else raises ValueError.
+        """
+        if order_by is None:
+            order_by = model_class._meta.ordering
+        order_by = list(order_by)
+        fields = self._order_fields(model_class, order_by)
+        pk = model_class._meta.pk
+        if pk not in fields:
+            order_by.append(pk.name)
+            fields.append(pk)
+        sql, values = self._select_sql(
+            model_class, (), kwargs,
+            order_by=order_by,
+            limit=limit + 1,
+            seek=self._decode_cursor(cursor, order_by) if cursor else None,
+        )
+        coro = self.read_conn.fetch(sql, *values)
+        res = await self._exec(coro, 'leoorm.get_page', sql, values)
+        if not res:
+            return [], None
+        load = self._loader(model_class, res[0], json_decoded=self.codecs)
+        instances = self._merge([load(d) for d in res[:limit]])
+        if len(res) <= limit:
+            return instances, None
+        last = instances[-1]
+        return instances, self._encode_cursor(
+            order_by, [getattr(last, f.attname) for f in fields])
+
+    def _merge(self, instances):
+        """
+        Replaces freshly loaded instances with the ones already in the
+        identity map and remembers the new ones.
+        """
+        if self.identity_map is None:
+            return instances
+        return [
+            self.identity_map.setdefault((instance.__class__, instance.pk), instance)
+            for instance in instances
+        ]
+
+    @classmethod
+    def _encode_cursor(cls, order_by, values):
+        # values travel as text and are cast back by the seek predicate;
+        # the ordering goes along so the cursor cannot be reused with another
+        data = json.dumps([order_by, [None if v is None else str(v) for v in values]])
+        return base64.urlsafe_b64encode(data.encode()).decode()
+
+    @classmethod
+    def _decode_cursor(cls, cursor, order_by):
+        try:
+            cursor_order_by, values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except (AttributeError, TypeError, ValueError):
+            raise ValueError('Incorrect cursor: {}'.format(cursor))
+        if (cursor_order_by != order_by or not isinstance(values, list)
+                or len(values) != len(order_by)
+                or not all(v is None or isinstance(v, str) for v in values)):
+            raise ValueError('Incorrect cursor: {}'.format(cursor))
+        return values
+
+    def _seek_cond(self, model_class, order_by, i):
+        fields = [self._field(model_class, f.lstrip('-')) for f in order_by]
+        desc = [f.startswith('-') for f in order_by]
+        params = [
+            '${}::text::{}'.format(i + j, f.cast_db_type(connection))
+            for j, f in enumerate(fields)
+        ]
+        columns = [f.column for f in fields]
+        if all(desc) or not any(desc):
+            return '({}) {} ({})'.format(
+                ', '.join(columns),
+                '<' if desc[0] else '>',
+                ', '.join(params),
             )
-        coro = self.conn.fetch(sql, *values)
-        res = await self._exec(coro, 'leoorm.get_list', sql, values)
-        return [self.to_model(model_class, d) for d in res]
+        # mixed directions: (a > $1) OR (a = $1 AND b < $2) OR ...
+        return '({})'.format(' OR '.join(
+            '({})'.format(' AND '.join(
+                ['{} = {}'.format(columns[k], params[k]) for k in range(j)] +
+                ['{} {} {}'.format(columns[j], '<' if desc[j] else '>', params[j])]
+            )) for j in range(len(columns))
+        ))
+
+    def _select_sql(self, model_class, args, kwargs, only=None, defer=None,
+                    order_by=None, limit=None, offset=None, seek=None, columns=None):
+        if args:
+            assert not (only or defer or order_by or limit or offset)
+            values = list(args)
+            return self._replace_tables(values.pop(0)), values
+        shape, values = self._shape(kwargs, model_class)
+        columns = columns or self._columns(model_class, only, defer)
+        if order_by is None:
+            order_by = model_class._meta.ordering
+        order_by = tuple(order_by)
+        has_limit = limit is not None
+        has_offset = offset is not None
+        if seek is not None:
+            assert len(seek) == len(order_by)
+            values += seek
+
+        def build():
+            i = len(values) + 1
+            bits = ['SELECT {} FROM {}'.format(
+                ', '.join(columns) if columns else '*',
+                self.db_table(model_class),
+            )]
+            cond = [self._cond(shape)] if shape else []
+            if seek is not None:
+                cond.append(self._seek_cond(
+                    model_class, order_by, len(values) - len(seek) + 1,
+                ))
+            if cond:
+                bits.append('WHERE {}'.format(' AND '.join(cond)))
+            if order_by:
+                bits.append(self._order_by(model_class, order_by))
+            if has_limit:
+                bits.append('LIMIT ${}'.format(i))
+                i += 1
+            if has_offset:
+                bits.append('OFFSET ${}'.format(i))
+            return ' '.join(bits)
+
+        sql = self._sql((
+            'select', model_class, shape, columns, order_by, has_limit, has_offset,
+            seek is not None,
+        ), build)
+        if has_limit:
+            values.append(limit)
+        if has_offset:
+            values.append(offset)
+        return sql, values
+
+    @classmethod
+    def _order_by(cls, model_class, order_by, prefix=''):
+        if not order_by:
+            return ''
+        return 'ORDER BY {}'.format(', '.join(
+            '{}{}{}'.format(prefix, f.column, ' DESC' if name.startswith('-') else '')
+            for name, f in zip(order_by, cls._order_fields(model_class, order_by))
+        ))
+
+    @classmethod
+    def _order_fields(cls, model_class, order_by):
+        # order_by often comes from request parameters, never pass it through
+        fields = [cls._field(model_class, name.lstrip('-')) for name in order_by]
+        unknown = [name for name, f in zip(order_by, fields) if f is None]
+        if unknown:
+            raise ValueError('Incorrect fields: {}. Allowed: {}'.format(
+                unknown,
+                ', '.join(f.name for f in cls._fields(model_class))
+            ))
+        return fields
+
+    @classmethod
+    def _field(cls, model_class, name):
+        if name == 'pk':
+            return model_class._meta.pk
+        for f in cls._fields(model_class):
+            if f.name == name or f.attname == name:
+                return f
+        return None
+
+    @classmethod
+    def _columns(cls, model_class, only=None, defer=None):
+        if not only and not defer:
+            return None
+        fields = cls._fields(model_class)
+        names = set(only or defer)
+        unknown = names - {f.name for f in fields} - {f.attname for f in fields}
+        if unknown:
+            raise ValueError('Incorrect fields: {}. Allowed: {}'.format(
+                sorted(unknown),
+                ', '.join(f.name for f in fields)
+            ))
+        pk = model_class._meta.pk
+        return tuple(
+            f.column for f in fields
+            if f is pk or (f.name in names or f.attname in names) == bool(only)
+        )
+
+    async def exists(self, model_class, **kwargs):
+        """
+        await orm.exists(model_class, field1=value, field2=value, ...) -> bool
+        """
+        shape, values = self._shape(kwargs, model_class)
+        sql = self._sql(('exists', model_class, shape), lambda: (
+            'SELECT 1 FROM {db_table} {maybecond} LIMIT 1'
+        ).format(
+            db_table=self.db_table(model_class),
+            maybecond='WHERE {}'.format(self._cond(shape)) if shape else '',
+        ))
+        coro = self.read_conn.fetchval(sql, *values)
+        return await self._exec(coro, 'leoorm.exists', sql, values) is not None
+
+    _aggregates = {
+        'count': 'COUNT',
+        'sum': 'SUM',
+        'avg': 'AVG',
+        'min': 'MIN',
+        'max': 'MAX',
+    }
+
+    async def aggregate(self, model_class, group_by=None, as_dict=False, **kwargs):
+        """
+        await orm.aggregate(model_class, sum='field', max='field2', field3=value, ...)
+            -> {'sum': ..., 'max': ...}
+        await orm.aggregate(model_class, group_by=['field', ...], count='*', ...)
+            -> [{'field': ..., 'count': ...}]
+        await orm.aggregate(model_class, group_by=['field'], count='*', as_dict=True, ...)
+            -> {field_value: {'count': ...}}
+
+        Keyword arguments named after an aggregate (count, sum, avg, min,
+        max) are aggregates, the rest are lookups as in get_list().
+        """
+        targets = [(k, kwargs.pop(k)) for k in self._aggregates if k in kwargs]
+        assert targets, 'nothing to aggregate'
+        group_by = list(group_by or ())
+        names = [name for k, name in targets if (k, name) != ('count', '*')] + group_by
+        fields = {name: self._field(model_class, name) for name in names}
+        unknown = [name for name, f in fields.items() if f is None]
+        if unknown:
+            raise ValueError('Incorrect fields: {}. Allowed: {}'.format(
+                unknown,
+                ', '.join(f.name for f in self._fields(model_class))
+            ))
+        aggregates = tuple(
+            (k, '*' if name not in fields else fields[name].column)
+            for k, name in targets
+        )
+        group_by = tuple(fields[name] for name in group_by)
+        shape, values = self._shape(kwargs, model_class)
+        sql = self._sql(('aggregate', model_class, shape, aggregates, group_by), lambda: (
+            'SELECT {columns} FROM {db_table} {maybecond} {maybegroup}'
+        ).format(
+            db_table=self.db_table(model_class),
+            columns=', '.join(
+                ['{} AS "{}"'.format(f.column, f.attname) for f in group_by] +
+                ['{}({}) AS "{}"'.format(self._aggregates[k], column, k)
+                 for k, column in aggregates]
+            ),
+            maybecond='WHERE {}'.format(self._cond(shape)) if shape else '',
+            maybegroup='GROUP BY {0} ORDER BY {0}'.format(
+                ', '.join(f.column for f in group_by)
+            ) if group_by else '',
+        ))
+        if not group_by:
+            coro = self.read_conn.fetchrow(sql, *values)
+            return dict(await self._exec(coro, 'leoorm.aggregate', sql, values))
+        coro = self.read_conn.fetch(sql, *values)
+        rows = await self._exec(coro, 'leoorm.aggregate', sql, values)
+        if not as_dict:
+            return [dict(row) for row in rows]
+        num_group = len(group_by)
+        result = {}
+        for row in rows:
+            row = tuple(row.values())
+            key = row[0] if num_group == 1 else row[:num_group]
+            result[key] = dict(zip((k for k, _ in aggregates), row[num_group:]))
+        return result
 
     async def count(self, model_class, **kwargs):
         """
         await orm.count(model_class, field1=value, field2=value, ...)
         """
-        cond, values = self._and(kwargs)
-        sql = 'SELECT COUNT(*) FROM {db_table} {maybecond}'.format(
+        shape, values = self._shape(kwargs, model_class)
+        sql = self._sql(('count', model_class, shape), lambda: (
+            'SELECT COUNT(*) FROM {db_table} {maybecond}'
+        ).format(
             db_table=self.db_table(model_class),
-            maybecond='WHERE {}'.format(cond) if cond else '',
-        )
-        coro = self.conn.fetchval(sql, *values)
-        return await self._exec(coro, 'leoorm.count', sql)
+            maybecond='WHERE {}'.format(self._cond(shape)) if shape else '',
+        ))
+        coro = self.read_conn.fetchval(sql, *values)
+        return await self._exec(coro, 'leoorm.count', sql, values)
 
     async def delete(self, instance, **kwargs):
         """
@@ -164,17 +1073,30 @@ class LeoORM:
         if hasattr(instance, 'objects'):
             model_class = instance
             assert kwargs
+            if self.identity_map is not None:
+                # which rows match is not known here
+                for key in [key for key in self.identity_map if key[0] is model_class]:
+                    del self.identity_map[key]
         else:
             model_class = instance.__class__
             assert not kwargs
             kwargs = {self.pk(model_class): instance.pk}
-        cond, values = self._and(kwargs)
-        sql = 'DELETE FROM {db_table} {maybecond}'.format(
+            if self.identity_map is not None:
+                self.identity_map.pop((model_class, instance.pk), None)
+        shape, values = self._shape(kwargs, model_class)
+        sql = self._sql(('delete', model_class, shape), lambda: (
+            'DELETE FROM {db_table} {maybecond}'
+        ).format(
             db_table=self.db_table(model_class),
-            maybecond='WHERE {}'.format(cond) if cond else '',
-        )
+            maybecond='WHERE {}'.format(self._cond(shape)) if shape else '',
+        ))
+        if self._batch is not None:
+            self._queue(sql, 'leoorm.delete', model_class, values)
+            return None
         coro = self.conn.fetchval(sql, *values)
-        return await self._exec(coro, 'leoorm.delete', sql, values)
+        result = await self._exec(coro, 'leoorm.delete', sql, values)
+        await self._invalidate(model_class)
+        return result
 
     async def exec(self, sql, *values):
         sql = self._replace_tables(sql)
@@ -183,13 +1105,157 @@ class LeoORM:
 
     async def get_raw_list(self, sql, *values):
         sql = self._replace_tables(sql)
-        coro = self.conn.fetch(sql, *values)
+        coro = self.read_conn.fetch(sql, *values)
         return await self._exec(coro, 'leoorm.get_raw_list', sql, values)
 
+    # seconds to wait for more orm.load() calls; 0 means the current loop iteration
+    load_delay = 0
+
+    async def load(self, model_class, value, key=None):
+        """
+        await orm.load(model_class, pk) -> instance or None
+        await orm.load(model_class, value, key='unique_field') -> instance or None
+
+        Calls made by concurrent coroutines in the same event loop iteration
+        are sent as one ANY($1) query per model and key. Results are kept
+        for the lifetime of the orm object.
+        """
+        field = self._load_field(model_class, key)
+        # one cancelled caller must not cancel the others
+        return await asyncio.shield(self._load_future(model_class, field, value))
+
+    async def load_many(self, model_class, values, key=None):
+        """
+        await orm.load_many(model_class, [pk, pk, ...]) -> [instance or None]
+        """
+        field = self._load_field(model_class, key)
+        return await asyncio.gather(*(
+            asyncio.shield(self._load_future(model_class, field, value))
+            for value in values
+        ))
+
+    def _load_field(self, model_class, key):
+        field = model_class._meta.pk if key is None else self._field(model_class, key)
+        if field is None or not (field.primary_key or field.unique):
+            raise ValueError('Not a unique field: {}'.format(key))
+        return field
+
+    def _load_future(self, model_class, field, value):
+        future = self._load_futures.get((model_class, field, value))
+        if future is not None:
+            return future
+        loop = asyncio.get_event_loop()
+        future = self._load_futures[model_class, field, value] = loop.create_future()
+        batch = self._load_batches.get((model_class, field))
+        if batch is None:
+            batch = self._load_batches[model_class, field] = {}
+            if self.load_delay:
+                loop.call_later(self.load_delay, self._dispatch_load, model_class, field)
+            else:
+                loop.call_soon(self._dispatch_load, model_class, field)
+        batch[value] = future
+        return future
+
+    def _dispatch_load(self, model_class, field):
+        batch = self._load_batches.pop((model_class, field))
+        asyncio.ensure_future(self._load_batch(model_class, field, batch))
+
+    async def _load_batch(self, model_class, field, batch):
+        if self._load_lock is None:
+            self._load_lock = asyncio.Lock()
+        try:
+            # batches of different models must not share the connection at once
+            async with self._load_lock:
+                if field.primary_key:
+                    found = await self._get_by_pks(model_class, batch)
+                else:
+                    found = await self._get_by_keys(model_class, field, batch)
+        except BaseException as e:
+            for value, future in batch.items():
+                # the next load() of these values tries again
+                self._load_futures.pop((model_class, field, value), None)
+                if future.done():
+                    continue
+                if isinstance(e, asyncio.CancelledError):
+                    future.cancel()
+                else:
+                    future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+        for value, future in batch.items():
+            if not future.done():
+                future.set_result(found.get(value))
+
+    async def _get_by_keys(self, model_class, field, keys):
+        sql = self._sql(('keys', model_class, field.column), lambda: (
+            'SELECT * FROM {db_table} WHERE {column} = ANY($1)'
+        ).format(
+            db_table=self.db_table(model_class),
+            column=field.column,
+        ))
+        values = [list(keys)]
+        coro = self.read_conn.fetch(sql, *values)
+        res = await self._exec(coro, 'leoorm.load', sql, values)
+        if not res:
+            return {}
+        load = self._loader(model_class, res[0], json_decoded=self.codecs)
+        return {
+            getattr(obj, field.attname): obj
+            for obj in self._merge([load(d) for d in res])
+        }
+
+    async def _get_by_pks(self, model_class, ids):
+        """
+        {pk: instance} for the given ids: the identity map and the object
+        cache first, then one ANY($1) query for the rest.
+        """
+        result = {}
+        ids = set(ids)
+        if self.identity_map is not None:
+            for val in ids:
+                obj = self.identity_map.get((model_class, val))
+                if obj is not None:
+                    result[val] = obj
+            ids -= result.keys()
+        cache = self.object_caches.get(model_class)
+        if cache is not None:
+            cached = [cache.get(('pk', val)) for val in ids]
+            cached = [d.copy() for d in cached if d is not MISSING]
+            if cached:
+                load = self._loader(model_class, cached[0], json_decoded=self.codecs)
+                result.update((obj.pk, obj) for obj in self._merge([load(d) for d in cached]))
+                ids -= result.keys()
+        if not ids:
+            return result
+        sql = self._sql(('pks', model_class), lambda: (
+            'SELECT * FROM {db_table} WHERE {pk} = ANY($1)'
+        ).format(
+            db_table=self.db_table(model_class),
+            pk=model_class._meta.pk.column,
+        ))
+        values = [list(ids)]
+        coro = self.read_conn.fetch(sql, *values)
+        res = await self._exec(coro, 'leoorm.get_list', sql, values)
+        if not res:
+            return result
+        if cache is not None:
+            pk_column = model_class._meta.pk.column
+            for d in res:
+                cache.set(('pk', d[pk_column]), CachedRow.from_record(d))
+        load = self._loader(model_class, res[0], json_decoded=self.codecs)
+        result.update((obj.pk, obj) for obj in self._merge([load(d) for d in res]))
+        return result
+
     async def prefetch(self, instance_or_list, *fields):
         """
         await orm.prefetch(instance, 'field', 'field', ...)
         await orm.prefetch([instance, instance], 'field', 'field', ...)
+        await orm.prefetch(instances, 'reverse_fk', 'm2m', 'field__nested__path')
+
+        Forward relations go to fields_cache, to-many relations (reverse FK
+        and many-to-many) become prefetched querysets, so instance.field.all()
+        works without a query. Nested paths cost one query per level.
         """
         if is_iterable(instance_or_list):
             if not instance_or_list:
@@ -203,70 +1269,224 @@ class LeoORM:
                 raise ValueError(instance_or_list)
             lst = [instance_or_list]
             model_class = instance_or_list.__class__
-        fields = list(fields)
-        model_fields = self._fields(model_class, one_to_one=True)
-        for f in model_fields:
-            if not f.is_relation or f.name not in fields:
-                continue
-            fields.remove(f.name)
-            if hasattr(f, 'attname'):
-                related_ids = {
-                    getattr(instance, f.attname) for instance in lst
-                    if not self.has_prefetched(instance, f.name) and
-                    getattr(instance, f.attname)
-                }
-                if not related_ids:
-                    continue
-                logger.debug(
-                    'leoorm.prefetch: %s from %s: %s',
-                    f.name,
-                    f.related_model.__qualname__,
-                    related_ids,
-                )
-                related_objects = {
-                    instance.pk: instance
-                    for instance in await self.get_list(f.related_model, '''
-                        SELECT * FROM {db_table} WHERE {pk} = ANY($1)
-                    '''.format(
-                        db_table=self.db_table(f.related_model),
-                        pk=self.pk(f.related_model),
-                    ), related_ids)
-                }
-                for instance in lst:
-                    val = getattr(instance, f.attname)
-                    if val and val in related_objects:
-                        self.set_prefetched(instance, f.name, related_objects[val])  # noqa
-                    elif not self.has_prefetched(instance, f.name):
-                        self.set_prefetched(instance, f.name, None)
-            else:
-                one2one_ids = {
-                    instance.pk for instance in lst
-                    if not self.has_prefetched(instance, f.name) and instance.pk
-                }
-                logger.debug(
-                    'leoorm.prefetch: %s from %s: %s',
-                    f.name,
-                    f.related_model.__qualname__,
-                    one2one_ids,
+        paths = fields
+        fields = []
+        nested = defaultdict(list)
+        for path in paths:
+            name, _, rest = path.partition('__')
+            if name not in fields:
+                fields.append(name)
+            if rest:
+                nested[name].append(rest)
+        relations = self._relations(model_class)
+        unknown = [name for name in fields if name not in relations]
+        if unknown:
+            raise ValueError('Incorrect fields: {}. Allowed: {}'.format(
+                unknown,
+                ', '.join(relations)
+            ))
+        funcs = [
+            partial(self._prefetch_path, lst, relations[name], nested.get(name))
+            for name in fields
+        ]
+        if len(funcs) > 1 and (self.pool is not None or hasattr(self.conn, 'acquire')):
+            await self._run_concurrently(funcs)
+        else:
+            for func in funcs:
+                await func(self)
+
+    @staticmethod
+    async def _prefetch_path(lst, f, rest, orm):
+        await orm._prefetch_field(lst, f)
+        if not rest:
+            return
+        related = {
+            id(obj): obj
+            for obj in orm._get_related(lst, f)
+            if obj is not None
+        }
+        if related:
+            await orm.prefetch(list(related.values()), *rest)
+
+    async def _run_concurrently(self, funcs):
+        """
+        Calls func(orm) for each of funcs, at most self.concurrency at once.
+        With a separate pool every call gets its own connection; when conn
+        is a pool itself, every query already does.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run(func):
+            async with semaphore:
+                if self.pool is None:
+                    return await func(self)
+                async with self.pool.acquire() as conn:
+                    orm = copy.copy(self)
+                    orm.conn = conn
+                    orm.codecs = has_codecs(conn)
+                    # nested prefetch() stays on this connection, acquiring
+                    # more while holding it can exhaust the pool
+                    orm.pool = None
+                    orm.i = 0
+                    try:
+                        return await func(orm)
+                    finally:
+                        self.i += orm.i
+
+        return await asyncio.gather(*(run(func) for func in funcs))
+
+    async def _prefetch_field(self, lst, f):
+        if f.one_to_many or f.many_to_many:
+            await self._prefetch_many(lst, f)
+        elif hasattr(f, 'attname'):
+            related_ids = {
+                getattr(instance, f.attname) for instance in lst
+                if not self.has_prefetched(instance, f.name) and
+                getattr(instance, f.attname)
+            }
+            if not related_ids:
+                return
+            logger.debug(
+                'leoorm.prefetch: %s from %s: %s',
+                f.name,
+                f.related_model.__qualname__,
+                related_ids,
+            )
+            related_objects = await self._get_by_pks(f.related_model, related_ids)
+            for instance in lst:
+                val = getattr(instance, f.attname)
+                if val and val in related_objects:
+                    self.set_prefetched(instance, f.name, related_objects[val])  # noqa
+                elif not self.has_prefetched(instance, f.name):
+                    self.set_prefetched(instance, f.name, None)
+        else:
+            one2one_ids = {
+                instance.pk for instance in lst
+                if not self.has_prefetched(instance, f.name) and instance.pk
+            }
+            logger.debug(
+                'leoorm.prefetch: %s from %s: %s',
+                f.name,
+                f.related_model.__qualname__,
+                one2one_ids,
+            )
+            if not one2one_ids:
+                return
+            one2one_objects = {
+                getattr(instance, f.field.column): instance
+                for instance in await self.get_list(
+                    f.related_model,
+                    **{f.field.column + '__in': one2one_ids}
                 )
-                if not one2one_ids:
-                    continue
-                one2one_objects = {
-                    getattr(instance, f.field.column): instance
-                    for instance in await self.get_list(
-                        f.related_model,
-                        **{f.field.column + '__in': one2one_ids}
-                    )
-                }
-                for instance in lst:
-                    val = one2one_objects.get(instance.pk)
-                    self.set_prefetched(instance, f.name, val)
+            }
+            for instance in lst:
+                val = one2one_objects.get(instance.pk)
+                self.set_prefetched(instance, f.name, val)
 
-        if fields:
-            raise ValueError('Incorrect fields: {}. Allowed: {}'.format(
-                fields,
-                ', '.join(f.name for f in model_fields)
+    async def _prefetch_many(self, lst, f):
+        ids = {instance.pk for instance in lst if instance.pk}
+        logger.debug(
+            'leoorm.prefetch: %s from %s: %s',
+            f.name,
+            f.related_model.__qualname__,
+            ids,
+        )
+        if not ids:
+            return
+        related_model = f.related_model
+        if f.one_to_many:
+            sql = self._sql(('prefetch', f), lambda: (
+                'SELECT * FROM {db_table} WHERE {column} = ANY($1) {ordering}'
+            ).format(
+                db_table=self.db_table(related_model),
+                column=f.field.column,
+                ordering=self._order_by(related_model, related_model._meta.ordering),
+            ))
+        else:
+            if f.concrete:
+                field, through = f, f.remote_field.through
+                src, dst = field.m2m_column_name(), field.m2m_reverse_name()
+            else:
+                field, through = f.field, f.through
+                src, dst = field.m2m_reverse_name(), field.m2m_column_name()
+            # one joined query through the intermediate table
+            sql = self._sql(('prefetch', f), lambda: (
+                'SELECT t.*, m.{src} AS _leoorm_src '
+                'FROM {db_table} t JOIN {through} m ON m.{dst} = t.{pk} '
+                'WHERE m.{src} = ANY($1) {ordering}'
+            ).format(
+                db_table=self.db_table(related_model),
+                through=self.db_table(through),
+                src=src,
+                dst=dst,
+                pk=related_model._meta.pk.column,
+                ordering=self._order_by(
+                    related_model, related_model._meta.ordering, prefix='t.'),
             ))
+        values = [list(ids)]
+        coro = self.read_conn.fetch(sql, *values)
+        rows = await self._exec(coro, 'leoorm.prefetch', sql, values)
+        groups = defaultdict(list)
+        if rows:
+            load = self._loader(related_model, rows[0], json_decoded=self.codecs)
+            by_pk = {}
+            pairs = []
+            for d in rows:
+                obj = load(d)
+                if f.one_to_many:
+                    src_id = getattr(obj, f.field.attname)
+                else:
+                    src_id = obj.__dict__.pop('_leoorm_src')
+                pairs.append((src_id, by_pk.setdefault(obj.pk, obj)))
+            merged = dict(zip(by_pk, self._merge(list(by_pk.values()))))
+            for src_id, obj in pairs:
+                groups[src_id].append(merged[obj.pk])
+        for instance in lst:
+            related = groups.get(instance.pk, [])
+            self._set_prefetched_many(instance, f, related)
+            if f.one_to_many:
+                for obj in related:
+                    self._set_prefetched(obj, f.field.name, instance)
+
+    @classmethod
+    def _many_cache_name(cls, f):
+        # the names Django related managers look up in _prefetched_objects_cache
+        if f.concrete:
+            return f.name
+        if f.many_to_many:
+            return f.field.related_query_name()
+        return f.get_cache_name()
+
+    @classmethod
+    def _set_prefetched_many(cls, obj, f, related):
+        qs = QuerySet(model=f.related_model)
+        qs._result_cache = related
+        qs._prefetch_done = True
+        if not hasattr(obj, '_prefetched_objects_cache'):
+            obj._prefetched_objects_cache = {}
+        obj._prefetched_objects_cache[cls._many_cache_name(f)] = qs
+
+    @classmethod
+    def _get_related(cls, lst, f):
+        if f.one_to_many or f.many_to_many:
+            name = cls._many_cache_name(f)
+            return [
+                obj for instance in lst
+                for obj in getattr(instance, '_prefetched_objects_cache', {}).get(name, ())
+            ]
+        return [cls.get_prefetched(instance, f.name) for instance in lst]
+
+    @classmethod
+    @lru_cache()
+    def _relations(cls, model_class):
+        result = {}
+        for f in model_class._meta.get_fields():
+            if not f.is_relation or f.related_model is None:
+                continue
+            result[f.name] = f
+            if f.auto_created and not f.concrete and f.get_accessor_name():
+                result.setdefault(f.get_accessor_name(), f)
+        return result
 
     @classmethod
     def set_prefetched(cls, obj, *args, **kwargs):
@@ -300,6 +1520,10 @@ class LeoORM:
         @classmethod
         def has_prefetched(cls, obj, name):
             return name in obj._state.fields_cache
+
+        @classmethod
+        def get_prefetched(cls, obj, name):
+            return obj._state.fields_cache.get(name)
     else:
         @classmethod
         def _set_prefetched(cls, obj, name, val):
@@ -309,16 +1533,59 @@ class LeoORM:
         def has_prefetched(cls, obj, name):
             return hasattr(obj, '_{}_cache'.format(name))
 
+        @classmethod
+        def get_prefetched(cls, obj, name):
+            return getattr(obj, '_{}_cache'.format(name), None)
+
     @classmethod
     def to_model(cls, model_class, d):
-        instance = model_class(**d)
-        for f in cls._fields(model_class):
-            if isinstance(f, JSONField):
-                val = getattr(instance, f.attname)
-                if isinstance(val, str):
-                    val = json.loads(val)
-                setattr(instance, f.attname, val)
-        return instance
+        return cls._loader(model_class, d)(d)
+
+    _loaders = {}
+
+    @classmethod
+    def _loader(cls, model_class, d, deferred=False, json_decoded=False):
+        """
+        Row -> instance function for one model and column layout. Skips
+        Model.__init__ (and its signals) the way Model.from_db would.
+        Fields missing from the row get defaults, or stay deferred.
+        JSON columns are decoded here unless the connection has codecs.
+        """
+        columns = tuple(d.keys())
+        key = model_class, columns, deferred, json_decoded
+        try:
+            return cls._loaders[key]
+        except KeyError:
+            pass
+        by_column = {f.column: f for f in cls._fields(model_class)}
+        attnames = [
+            by_column[c].attname if c in by_column else c
+            for c in columns
+        ]
+        json_indexes = [] if json_decoded else [
+            i for i, c in enumerate(columns)
+            if isinstance(by_column.get(c), JSONField)
+        ]
+        missing = [] if deferred else [
+            f for c, f in by_column.items() if c not in columns
+        ]
+        new = model_class.__new__
+
+        def load(row):
+            values = list(row.values())
+            for i in json_indexes:
+                if isinstance(values[i], str):
+                    values[i] = json.loads(values[i])
+            instance = new(model_class)
+            instance.__dict__.update(zip(attnames, values))
+            for f in missing:
+                instance.__dict__[f.attname] = f.get_default()
+            instance._state = state = ModelState()
+            state.adding = False
+            return instance
+
+        cls._loaders[key] = load
+        return load
 
     @classmethod
     def db_table(cls, obj):
@@ -330,7 +1597,13 @@ class LeoORM:
 
     _tables = {}
 
+    def _sql(self, key, build):
+        return self.sql_cache.get(key, build)
+
     def _replace_tables(self, sql):
+        return self.sql_cache.get(sql, lambda: self._format_tables(sql))
+
+    def _format_tables(self, sql):
         if not self._tables:
             models = defaultdict(dict)
             for m in django.apps.apps.get_models(include_auto_created=True):
@@ -344,11 +1617,15 @@ class LeoORM:
     async def _exec(self, coro, name, sql, values=None):
         ms = Measure()
         self.i += 1
+        started = False
         try:
+            for hook in self.before_query_hooks:
+                hook(self, name, sql, values)
+            started = True
             result = await coro
         except (KeyboardInterrupt, asyncio.CancelledError):
             raise
-        except:
+        except BaseException as e:
             logger.exception(
                 '%s: #%d %s: %s %s',
                 name,
@@ -357,65 +1634,124 @@ class LeoORM:
                 sql,
                 LazyStr(lambda: dict(enumerate(values, start=1)) if values else ''),  # noqa
             )
+            if self.metrics is not None or self.after_query_hooks:
+                self._after_query(name, sql, values, ms.get_ms(), None, e)
             raise
-        logger.debug(
-            '%s: #%d %s: %s %s\n%s',
-            name,
-            self.i,
-            ms,
-            sql,
-            LazyStr(lambda: dict(enumerate(values, start=1)) if values else ''),  # noqa
-            LazyStr(lambda: FromLine(1)),
-        )
+        finally:
+            if not started and hasattr(coro, 'close'):
+                # a before-query hook failed, the query never ran
+                coro.close()
+        if self.metrics is not None or self.after_query_hooks:
+            self._after_query(name, sql, values, ms.get_ms(), result, None)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                '%s: #%d %s: %s %s\n%s',
+                name,
+                self.i,
+                ms,
+                sql,
+                LazyStr(lambda: dict(enumerate(values, start=1)) if values else ''),  # noqa
+                LazyStr(lambda: FromLine(1)),
+            )
         return result
 
-    _ops = {
-        'gt': '>',
-        'gte': '>=',
-        'lt': '<',
-        'lte': '<=',
-        'in': 'ANY',
-        'isnull': 'IS NULL',
-        'contains': '~',
-        'icontains': '~*',
-    }
+    # process-wide instrumentation, see leoorm.metrics
+    metrics = None
+    # hook(orm, name, sql, values)
+    before_query_hooks = []
+    # hook(orm, name, sql, values, ms, result, error)
+    after_query_hooks = []
+
+    def _after_query(self, name, sql, values, ms, result, error):
+        if self.metrics is not None:
+            self.metrics.record(name, sql, ms, count_rows(result), error)
+        for hook in self.after_query_hooks:
+            hook(self, name, sql, values, ms, result, error)
+
+    def _shape(self, kwargs, model_class=None):
+        """
+        Splits lookups into a hashable shape, ((column, kind, lookup, negate), ...),
+        which alone defines the SQL, and the list of query arguments.
+
+            field=value, field__lookup=value, field__not__lookup=value,
+            json_field__key__key__lookup=value
+
+        See leoorm.lookups for the available lookups.
+        """
+        shape = []
+        values = []
+        for k, v in kwargs.items():
+            name, *path = k.split('__')
+            f = self._field(model_class, name) if model_class else None
+            column = f.column if f else name
+            kind = (
+                'json' if isinstance(f, JSONField) else
+                'array' if isinstance(f, ArrayField) else
+                None
+            )
+            lookup = path.pop() if path and lookups.get(path[-1], kind) else 'exact'
+            negate = bool(path) and path[-1] == 'not'
+            if negate:
+                path.pop()
+            if path:
+                assert kind == 'json', 'bad condition: {}'.format(k)
+                column, kind = self._json_path(column, path, lookup, v)
+            if v is None and lookup in ('exact', 'ne'):
+                lookup = 'isnull' if lookup == 'exact' else 'notnull'
+            elif lookup == 'isnull' and not v:
+                lookup = 'notnull'
+            elif lookup == 'exact' and kind is None and isinstance(v, (list, set, tuple)):
+                lookup = 'in'
+            op = lookups.get(lookup, kind)
+            if op.prepare:
+                v = op.prepare(v)
+            if op.nargs == 1:
+                values.append(v)
+            elif op.nargs:
+                values.extend(v)
+            shape.append((column, kind, lookup, negate))
+        return tuple(shape), values
+
+    @staticmethod
+    def _json_path(column, path, lookup, value):
+        keys = ["'{}'".format(key.replace("'", "''")) for key in path]
+        if ('json', lookup) in lookups.registry and (
+            lookup != 'exact' or isinstance(value, (dict, list))
+        ):
+            return '({})'.format(' -> '.join([column] + keys)), 'json'
+        expr = '({} ->> {})'.format(' -> '.join([column] + keys[:-1]), keys[-1])
+        sample = value
+        if isinstance(value, (list, set, tuple)):
+            sample = next(iter(value), None)
+        # ->> gives text, compare numbers and booleans as such
+        if lookup in ('isnull', 'notnull'):
+            pass
+        elif isinstance(sample, bool):
+            expr += '::boolean'
+        elif isinstance(sample, Number):
+            expr += '::numeric'
+        return expr, None
+
+    def _cond(self, shape):
+        return self._sql(('cond', shape), lambda: self._build_cond(shape))
 
-    def _and(self, kwargs):
+    @classmethod
+    def _build_cond(cls, shape):
         i = 1
         bits = []
-        values = []
-        for k in kwargs:
-            if '__' in k:
-                field, *etc = k.split('__')
-                assert len(etc) == 1
-                op = self._ops.get(etc[0])
-                assert op, 'bad condition: {}'.format(k)
-            else:
-                field = k
-                op = '='
-            if kwargs[k] is None:
-                assert op == '='
-                bits.append('{} IS NULL'.format(field))
-            else:
-                if (
-                    op == 'ANY' or
-                    isinstance(kwargs[k], (list, set, dict, tuple))  # XXX:
-                ):
-                    kwargs[k] = list(kwargs[k])
-                    bits.append('{} = ANY(${})'.format(field, i))
-                elif op == 'IS NULL':
-                    if kwargs[k]:
-                        bits.append('{} IS NULL'.format(field))
-                    else:
-                        bits.append('{} IS NOT NULL'.format(field))
-                    continue  # чтобы аргумен пропустить
-                else:
-                    bits.append('{} {} ${}'.format(field, op, i))
-                values.append(kwargs[k])
-                i += 1
-        return ' AND '.join(bits), values
+        for column, kind, name, negate in shape:
+            lookup = lookups.get(name, kind)
+            args = ['${}'.format(i + j) for j in range(lookup.nargs)]
+            i += lookup.nargs
+            bit = lookup.template.format(
+                column=column,
+                arg=args[0] if args else None,
+                args=args,
+            )
+            bits.append('NOT ({})'.format(bit) if negate else bit)
+        return ' AND '.join(bits)
 
-    def _names_values(self, instances, update_fields=None):
+    def _names_values(self, instances, update_fields=None, only=None):
         names = []
         values = [[] for _ in instances]
         model_class = instances[0].__class__
@@ -424,6 +1760,8 @@ class LeoORM:
         for field in self._fields(model_class):
             if field.name == self.pk(model_class):
                 continue
+            if only and field.attname not in only and field.name not in only:
+                continue
             if (
                 not update_fields or
                 field.attname in update_fields or  # 'task_group_id'
@@ -445,7 +1783,7 @@ class LeoORM:
                     else:
                         val = getattr(obj, field.attname)
                     if isinstance(field, JSONField):
-                        if val is not None:
+                        if val is not None and not self.codecs:
                             val = json.dumps(val, ensure_ascii=False)
                     elif isinstance(field, FileField):
                         val = str(val)
@@ -458,6 +1796,8 @@ class LeoORM:
         assert names
         if update_fields:
             assert len(update_fields) == len(names)
+        if only:
+            assert len(only) == len(names)
         return names, values
 
     @classmethod
@@ -472,3 +1812,6 @@ class LeoORM:
                 result.append(f)
                 continue
         return result
+
+
+lookups.on_register.append(lambda: LeoORM.sql_cache.clear())
@@ -1,11 +1,18 @@
+import asyncio
+import json
 import logging
+import re
 import time
 import traceback
+from collections import deque
 from contextlib import contextmanager
+from contextvars import ContextVar
 
 from django.conf import settings
 from django.db.backends.utils import CursorDebugWrapper
 
+from .metrics import normalize_sql
+
 logger = logging.getLogger('leoorm')
 
 
@@ -110,12 +117,13 @@ class FromLine:
         'logging',
         'Cython',
         'unittest',
-    )):
+    ), force=False):
         self.depth = depth
         self.skip = skip
+        self.force = force
 
     def __str__(self):
-        if not settings.DEBUG:
+        if not settings.DEBUG and not self.force:
             return ''
         lines = []
         for line in reversed(traceback.format_stack()):
@@ -133,3 +141,170 @@ class LazyStr:
 
     def __str__(self):
         return str(self.func())
+
+
+class SlowQueryLog:
+    """
+    LeoORM.after_query_hooks.append(SlowQueryLog(threshold_ms=200, explain_pool=pool))
+
+    Keeps the last `maxlen` queries slower than threshold_ms with their
+    arguments and call site. With explain_pool the plan is added later by
+    EXPLAIN (ANALYZE false, FORMAT JSON) on a connection from that pool.
+    """
+    explainable = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')
+
+    def __init__(self, threshold_ms=200, maxlen=100, explain_pool=None):
+        self.threshold_ms = threshold_ms
+        self.explain_pool = explain_pool
+        self.entries = deque(maxlen=maxlen)
+
+    def __call__(self, orm, name, sql, values, ms, result, error):
+        if ms < self.threshold_ms:
+            return
+        entry = {
+            'name': name,
+            'sql': sql,
+            'values': list(values) if values else [],
+            'ms': ms,
+            'line': str(FromLine(1, force=True)),
+            'error': repr(error) if error else None,
+            'plan': None,
+        }
+        self.entries.append(entry)
+        logger.warning('%s: slow query %s: %s\n%s', name, Measure.timeformat(ms), sql, entry['line'])
+        if (
+            self.explain_pool is not None and
+            sql.split(None, 1)[0].upper() in self.explainable and
+            # bulk statements are logged without their arguments
+            (values or '$' not in sql)
+        ):
+            asyncio.ensure_future(self._explain(entry))
+
+    async def _explain(self, entry):
+        try:
+            async with self.explain_pool.acquire() as conn:
+                plan = await conn.fetchval(
+                    'EXPLAIN (ANALYZE false, FORMAT JSON) ' + entry['sql'],
+                    *entry['values']
+                )
+        except Exception:
+            logger.exception('leoorm.SlowQueryLog: EXPLAIN failed: %s', entry['sql'])
+            return
+        entry['plan'] = json.loads(plan) if isinstance(plan, str) else plan
+
+    def dump(self):
+        return list(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+
+
+_n_plus_one = ContextVar('leoorm_n_plus_one', default=None)
+
+
+class NPlusOneDetector:
+    """
+    with NPlusOneDetector(threshold=5) as detector:
+        ... await orm.get(...) in a loop ...
+    detector.report() -> [{'sql': ..., 'count': ..., 'ms': ..., 'line': ..., 'hint': ...}]
+
+    Counts LeoORM queries by shape inside the block (and tasks started in
+    it) and warns about shapes repeated more than `threshold` times.
+    """
+    def __init__(self, threshold=5):
+        self.threshold = threshold
+        self.shapes = {}
+        self._token = None
+
+    def __enter__(self):
+        from .core import LeoORM
+        self._token = _n_plus_one.set(self)
+        LeoORM.after_query_hooks.append(self._hook)
+        return self
+
+    def __exit__(self, *exc_info):
+        from .core import LeoORM
+        LeoORM.after_query_hooks.remove(self._hook)
+        _n_plus_one.reset(self._token)
+        for item in self.report():
+            logger.warning(
+                'leoorm.NPlusOneDetector: %d x %s (%s): %s\n%s\n%s',
+                item['count'],
+                item['name'],
+                Measure.timeformat(item['ms']),
+                item['sql'],
+                item['line'],
+                item['hint'],
+            )
+
+    def _hook(self, orm, name, sql, values, ms, result, error):
+        if _n_plus_one.get() is not self:
+            return
+        key = normalize_sql(sql)
+        item = self.shapes.get(key)
+        if item is None:
+            item = self.shapes[key] = {
+                'name': name,
+                'sql': key,
+                'count': 0,
+                'ms': 0.0,
+                'line': '',
+            }
+        item['count'] += 1
+        item['ms'] += ms
+        if item['count'] == self.threshold + 1:
+            item['line'] = str(FromLine(1, force=True))
+
+    def report(self):
+        return [
+            dict(item, hint=self.hint(item['name'], item['sql']))
+            for item in self.shapes.values()
+            if item['count'] > self.threshold
+        ]
+
+    @classmethod
+    def hint(cls, name, sql):
+        if name == 'leoorm._update':
+            return 'use orm.update(instances, *fields)'
+        if name == 'leoorm._save_one':
+            return 'use orm.save([instance, ...])'
+        match = re.search(r'\bFROM (\w+) WHERE (\w+) = \$1\b', sql)
+        model_class = match and _models_by_table().get(match.group(1))
+        if model_class is None:
+            return 'batch these queries'
+        column = match.group(2)
+        if column == model_class._meta.pk.column:
+            fks = [
+                '{}.{}'.format(f.model.__name__, f.name)
+                for f in _foreign_keys_to(model_class)
+            ]
+            return 'use orm.load({}, pk) or orm.prefetch(instances, ...) for {}'.format(
+                model_class.__name__,
+                ', '.join(fks) or 'the relation',
+            )
+        for f in model_class._meta.get_fields():
+            if f.is_relation and f.many_to_one and f.column == column:
+                return 'use orm.prefetch({} instances, {!r})'.format(
+                    f.related_model.__name__,
+                    f.remote_field.get_accessor_name(),
+                )
+        return 'batch these queries'
+
+
+def _models_by_table():
+    import django.apps
+    return {
+        m._meta.db_table: m
+        for m in django.apps.apps.get_models(include_auto_created=True)
+    }
+
+
+def _foreign_keys_to(model_class):
+    import django.apps
+    return [
+        f
+        for m in django.apps.apps.get_models()
+        for f in m._meta.get_fields()
+        if f.is_relation and f.many_to_one and f.concrete and
+        f.related_model is model_class
+    ]
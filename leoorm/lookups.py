@@ -0,0 +1,73 @@
+"""
+Filter lookups: orm.get_list(Book, title__startswith='A', id__range=(1, 10))
+
+A lookup is an SQL template with {column} and {arg} ({args[0]}, {args[1]}
+for several arguments) plus an optional function preparing the value.
+Lookups can be registered for plain, 'json' or 'array' fields, the
+field kind is tried first:
+
+    from leoorm import lookups
+    lookups.register('similar', '{column} % {arg}')
+"""
+import json
+from collections import namedtuple
+
+Lookup = namedtuple('Lookup', 'template prepare nargs')
+
+# (kind, name) -> Lookup, kind is None, 'json' or 'array'
+registry = {}
+# called after every register(), LeoORM drops SQL built with old templates
+on_register = []
+
+
+def register(name, template, prepare=None, nargs=1, kind=None):
+    registry[kind, name] = Lookup(template, prepare, nargs)
+    for callback in on_register:
+        callback()
+
+
+def get(name, kind=None):
+    return registry.get((kind, name)) or registry.get((None, name))
+
+
+def like_escape(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def json_dumps(value):
+    return json.dumps(value, ensure_ascii=False)
+
+
+register('exact', '{column} = {arg}')
+register('ne', '{column} <> {arg}')
+register('gt', '{column} > {arg}')
+register('gte', '{column} >= {arg}')
+register('lt', '{column} < {arg}')
+register('lte', '{column} <= {arg}')
+register('in', '{column} = ANY({arg})', list)
+register('range', '{column} BETWEEN {args[0]} AND {args[1]}', tuple, nargs=2)
+register('isnull', '{column} IS NULL', nargs=0)
+register('notnull', '{column} IS NOT NULL', nargs=0)
+
+# LIKE with a constant prefix can use a btree index (text_pattern_ops or
+# the C collation), the rest are served by pg_trgm GIN indexes
+register('startswith', '{column} LIKE {arg}', lambda v: like_escape(v) + '%')
+register('istartswith', '{column} ILIKE {arg}', lambda v: like_escape(v) + '%')
+register('endswith', '{column} LIKE {arg}', lambda v: '%' + like_escape(v))
+register('iendswith', '{column} ILIKE {arg}', lambda v: '%' + like_escape(v))
+register('contains', '{column} LIKE {arg}', lambda v: '%' + like_escape(v) + '%')
+register('icontains', '{column} ILIKE {arg}', lambda v: '%' + like_escape(v) + '%')
+register('regex', '{column} ~ {arg}')
+register('iregex', '{column} ~* {arg}')
+
+# GIN-friendly containment; JSON goes as text, whatever the jsonb codec is
+register('exact', '{column} = {arg}::text::jsonb', json_dumps, kind='json')
+register('contains', '{column} @> {arg}::text::jsonb', json_dumps, kind='json')
+register('contained_by', '{column} <@ {arg}::text::jsonb', json_dumps, kind='json')
+register('has_key', '{column} ? {arg}', kind='json')
+register('has_keys', '{column} ?& {arg}::text[]', list, kind='json')
+register('has_any_keys', '{column} ?| {arg}::text[]', list, kind='json')
+
+register('contains', '{column} @> {arg}', list, kind='array')
+register('contained_by', '{column} <@ {arg}', list, kind='array')
+register('overlap', '{column} && {arg}', list, kind='array')
@@ -0,0 +1,94 @@
+import re
+from collections import deque
+from functools import lru_cache
+
+_literals = re.compile(r"'(?:[^']|'')*'|(?<!\$)\b\d+(?:\.\d+)?\b")
+
+
+@lru_cache(maxsize=4096)
+def normalize_sql(sql):
+    """
+    SQL shape for grouping: literals replaced with ?, whitespace collapsed.
+    $1-style parameters are kept, they are already part of the shape.
+    """
+    return ' '.join(_literals.sub('?', sql).split())
+
+
+class QueryStats:
+    __slots__ = ('count', 'errors', 'rows', 'total_ms', 'latencies')
+
+    def __init__(self, window):
+        self.count = 0
+        self.errors = 0
+        self.rows = 0
+        self.total_ms = 0.0
+        # percentiles are taken over the last `window` queries
+        self.latencies = deque(maxlen=window)
+
+    def add(self, ms, rows, error):
+        self.count += 1
+        self.total_ms += ms
+        self.rows += rows
+        if error:
+            self.errors += 1
+        self.latencies.append(ms)
+
+    def percentile(self, p):
+        if not self.latencies:
+            return 0.0
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'rows': self.rows,
+            'total_ms': self.total_ms,
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'p99_ms': self.percentile(99),
+        }
+
+
+class QueryMetrics:
+    """
+    LeoORM.metrics = QueryMetrics()
+    ...
+    LeoORM.metrics.report() -> {'by_name': {...}, 'by_sql': {...}}
+    """
+    def __init__(self, window=1000):
+        self.window = window
+        self.by_name = {}
+        self.by_sql = {}
+
+    def record(self, name, sql, ms, rows, error=None):
+        for stats, key in (
+            (self.by_name, name),
+            (self.by_sql, normalize_sql(sql)),
+        ):
+            try:
+                item = stats[key]
+            except KeyError:
+                item = stats[key] = QueryStats(self.window)
+            item.add(ms, rows, error)
+
+    def report(self):
+        return {
+            'by_name': {k: v.as_dict() for k, v in self.by_name.items()},
+            'by_sql': {k: v.as_dict() for k, v in self.by_sql.items()},
+        }
+
+    def reset(self):
+        self.by_name.clear()
+        self.by_sql.clear()
+
+
+def count_rows(result):
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, str):
+        # execute() status, e.g. 'UPDATE 5'
+        tail = result.rsplit(' ', 1)[-1]
+        return int(tail) if tail.isdigit() else 0
+    return int(result is not None)
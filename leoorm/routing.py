@@ -0,0 +1,68 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_primary_only = ContextVar('leoorm_primary_only', default=False)
+
+
+class PoolSet:
+    """
+    One primary pool and any number of replica pools, to be passed to
+    LeoORM instead of a connection:
+
+        pools = await create_db_pools('default', replicas=['replica1', 'replica2'])
+        orm = LeoORM(pools)
+
+    Writes and everything LeoORM does not know to be a read go to the
+    primary. Reads go to the replica with the fewest queries in flight,
+    or to the primary inside `with pools.read_your_writes():`.
+    """
+    def __init__(self, primary, replicas=()):
+        self.primary = primary
+        self.replicas = [Replica(pool) for pool in replicas]
+
+    @property
+    def reader(self):
+        if not self.replicas or _primary_only.get():
+            return self.primary
+        return min(self.replicas, key=lambda r: r.outstanding)
+
+    @contextmanager
+    def read_your_writes(self):
+        token = _primary_only.set(True)
+        try:
+            yield
+        finally:
+            _primary_only.reset(token)
+
+    async def close(self):
+        for replica in self.replicas:
+            await replica.pool.close()
+        await self.primary.close()
+
+    def __getattr__(self, name):
+        return getattr(self.primary, name)
+
+
+class Replica:
+    def __init__(self, pool):
+        self.pool = pool
+        self.outstanding = 0
+
+    async def _call(self, method, *args, **kwargs):
+        self.outstanding += 1
+        try:
+            return await getattr(self.pool, method)(*args, **kwargs)
+        finally:
+            self.outstanding -= 1
+
+    def fetch(self, *args, **kwargs):
+        return self._call('fetch', *args, **kwargs)
+
+    def fetchrow(self, *args, **kwargs):
+        return self._call('fetchrow', *args, **kwargs)
+
+    def fetchval(self, *args, **kwargs):
+        return self._call('fetchval', *args, **kwargs)
+
+    def __repr__(self):
+        return '<Replica: {} outstanding>'.format(self.outstanding)
@@ -1,31 +1,171 @@
-import base64
+import asyncio
+import copy
+from functools import partial
+from importlib import import_module
 
 from django.conf import settings
+from django.contrib.sessions.backends import cache, cached_db, db
 from django.contrib.sessions.models import Session
+from django.core.cache import caches
+from django.db import connections
+from django.db.models.signals import post_delete, post_save
+from django.utils.timezone import now
+
+from .cache import MISSING, ObjectCache
+
+# session key -> (session dict, expire_date), sessions read from the database
+session_cache = ObjectCache(maxsize=10000, ttl=30)
+session_channel = 'leoorm_sessions'
 
 
 async def get_dj_session(orm, cookies):
-    import ujson
-    # FIXME: non-dbbackend and non-json support
+    """
+    await get_dj_session(orm, cookies) -> dict
+
+    Reads the session the way the configured SESSION_ENGINE would: db,
+    cache and cached_db directly, other engines through their
+    SessionStore in a thread. Session data from the database is verified
+    with Django's own decode(). Every call returns a new dict.
+
+    Sessions read from the database stay in session_cache for its ttl, or
+    until the Session row is saved or deleted in a process that called
+    connect_session_invalidation(), see listen_session_invalidations().
+    Sessions found in Django's cache are not kept, that cache is shared
+    already.
+    """
     session_key = cookies.get(settings.SESSION_COOKIE_NAME)
     if not session_key:
         return {}
+    cached = session_cache.get(session_key)
+    if cached is not MISSING:
+        session, expire_date = cached
+        if expire_date is None or expire_date > now():
+            return copy.deepcopy(session)
+    session, expire_date = await _load_session(orm, session_key)
+    if session and expire_date is not None:
+        session_cache.set(session_key, (copy.deepcopy(session), expire_date))
+    return session
+
 
-    dj_sess = await orm.get(Session, session_key=session_key)
+async def _load_session(orm, session_key):
+    store = import_module(settings.SESSION_ENGINE).SessionStore(session_key)
+    loop = asyncio.get_event_loop()
+    if isinstance(store, (cache.SessionStore, cached_db.SessionStore)):
+        dj_cache = caches[settings.SESSION_CACHE_ALIAS]
+        session = await loop.run_in_executor(
+            None, dj_cache.get, store.cache_key)
+        if session is not None:
+            return session, None
+        if not isinstance(store, cached_db.SessionStore):
+            return {}, None
+    elif not isinstance(store, db.SessionStore):
+        session = await loop.run_in_executor(None, store.load)
+        return dict(session), None
+    dj_sess = await orm.get(Session, session_key=session_key, expire_date__gt=now())
     if not dj_sess:
-        return {}
+        return {}, None
+    session = store.decode(dj_sess.session_data)
+    if session and isinstance(store, cached_db.SessionStore):
+        await loop.run_in_executor(None, partial(
+            dj_cache.set,
+            store.cache_key,
+            session,
+            store.get_expiry_age(expiry=dj_sess.expire_date),
+        ))
+    return session, dj_sess.expire_date
+
+
+async def listen_session_invalidations(conn):
+    """
+    callback = await listen_session_invalidations(conn)
+
+    Drops sessions from session_cache when another process saves or
+    deletes them, see connect_session_invalidation(). conn must be a dedicated connection that
+    stays open; the returned callback can be passed to conn.remove_listener().
+    """
+    def callback(conn, pid, channel, payload):
+        session_cache.delete(payload)
+
+    await conn.add_listener(session_channel, callback)
+    return callback
+
 
-    # FIXME: hash checking
-    _hash, decoded = base64.b64decode(dj_sess.session_data).split(b':', 1)
-    return ujson.loads(decoded)
+def connect_session_invalidation():
+    """
+    Call once at startup of processes that change sessions through Django.
+    Saving or deleting a Session then drops it from session_cache here
+    and, with NOTIFY, in processes running listen_session_invalidations().
 
+    Every Session save or delete costs one more query, and a post_delete
+    receiver turns off Django's fast delete for Session: clearsessions
+    loads the expired rows before deleting them. Those are skipped here,
+    get_dj_session() checks expire_date anyway.
+    """
+    post_save.connect(_drop_cached_session, sender=Session,
+                      dispatch_uid='leoorm_session_invalidation')
+    post_delete.connect(_drop_cached_session, sender=Session,
+                        dispatch_uid='leoorm_session_invalidation')
 
-async def create_db_pool(using='default', **kwargs):
+
+def disconnect_session_invalidation():
+    post_save.disconnect(sender=Session, dispatch_uid='leoorm_session_invalidation')
+    post_delete.disconnect(sender=Session, dispatch_uid='leoorm_session_invalidation')
+
+
+def _drop_cached_session(sender, instance, using, signal, **kwargs):
+    if signal is post_delete and instance.expire_date <= now():
+        return
+    session_cache.delete(instance.session_key)
+    db_connection = connections[using]
+    if db_connection.vendor == 'postgresql':
+        # delivered on commit
+        with db_connection.cursor() as cursor:
+            cursor.execute('SELECT pg_notify(%s, %s)', [session_channel, instance.session_key])
+
+
+async def create_db_pool(using='default', codecs=False, json_dumps=None, json_loads=None,
+                         prepare=(), init=None, **kwargs):
+    """
+    codecs: json/jsonb codecs on every connection, see
+        leoorm.codecs.setup_codecs(); LeoORM then skips its own JSON work.
+        Raw queries on such a pool take and return Python objects for JSON,
+        not JSON strings.
+    json_dumps, json_loads: serializer for the json codecs
+    prepare: SQL statements to prepare on every new connection, see
+        leoorm.codecs.prepare_statements()
+    init: called with every new connection after the above
+
+    The pool opens min_size connections right away; statement_cache_size
+    and the other asyncpg.connect() arguments are passed through.
+    """
     import asyncpg
+    from .codecs import Connection, prepare_statements, setup_codecs
+
+    async def init_connection(conn):
+        if codecs:
+            await setup_codecs(conn, json_dumps, json_loads)
+        if prepare:
+            await prepare_statements(conn, prepare)
+        if init:
+            await init(conn)
+
     return await asyncpg.create_pool(
         user=settings.DATABASES[using]['USER'],
         password=settings.DATABASES[using]['PASSWORD'],
         database=settings.DATABASES[using]['NAME'],
         host=settings.DATABASES[using]['HOST'],
+        connection_class=Connection if codecs else asyncpg.Connection,
+        init=init_connection,
         **kwargs
     )
+
+
+async def create_db_pools(using='default', replicas=(), **kwargs):
+    """
+    await create_db_pools('default', replicas=['replica1', ...]) -> PoolSet
+    """
+    from .routing import PoolSet
+    return PoolSet(
+        await create_db_pool(using, **kwargs),
+        [await create_db_pool(alias, **kwargs) for alias in replicas],
+    )
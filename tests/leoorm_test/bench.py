@@ -0,0 +1,239 @@
+import asyncio
+import platform
+import time
+
+import asyncpg
+import django
+
+from leoorm import LeoORM
+from leoorm.utils import create_db_pool
+from .models import Author, Book, Color
+
+
+class Bench:
+    """
+    LeoORM vs Django ORM on the leoorm_test database. Every scenario is run
+    `repeat` times and the best time is kept.
+    """
+    def __init__(self, sizes=(10, 1000, 100000), repeat=3, clients=10, log=print):
+        if clients < 2:
+            # one connection is held by self.conn, the rest are clients
+            raise ValueError('clients must be at least 2')
+        self.sizes = sizes
+        self.repeat = repeat
+        self.clients = clients
+        self.log = log
+        self.results = []
+        self.loop = asyncio.get_event_loop()
+        self.pool = self.loop.run_until_complete(
+            create_db_pool(min_size=clients, max_size=clients))
+        self.conn = self.loop.run_until_complete(self.pool.acquire())
+        self.orm = LeoORM(self.conn)
+
+    def run(self):
+        self.clear()
+        self.bench_insert(100)
+        for n in self.sizes:
+            self.bench_bulk_insert(n)
+        for n in self.sizes:
+            # Django's bulk_update builds CASE WHEN per row and gets very slow
+            if n <= 10000:
+                self.bench_update(n)
+        self.bench_get(100)
+        for n in self.sizes:
+            self.bench_get_list(n)
+        self.bench_count(100)
+        self.bench_prefetch(1000)
+        for n in self.sizes:
+            self.bench_to_model(n)
+        self.bench_concurrent(1000)
+        self.loop.run_until_complete(self.pool.release(self.conn))
+        self.loop.run_until_complete(self.pool.close())
+        return {
+            'meta': {
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'asyncpg': asyncpg.__version__,
+                'repeat': self.repeat,
+                'clients': self.clients,
+            },
+            'results': self.results,
+        }
+
+    def measure(self, func, setup=None):
+        best = None
+        for _ in range(self.repeat):
+            if setup:
+                setup()
+            start = time.perf_counter()
+            func()
+            ms = (time.perf_counter() - start) * 1000
+            best = ms if best is None else min(best, ms)
+        return best
+
+    def compare(self, scenario, size, django_func, leoorm_coro, setup=None):
+        result = {
+            'scenario': scenario,
+            'size': size,
+            'django_ms': self.measure(django_func, setup),
+            'leoorm_ms': self.measure(
+                lambda: self.loop.run_until_complete(leoorm_coro(self.orm)),
+                setup,
+            ),
+        }
+        self.results.append(result)
+        self.log('{scenario:>12} {size:>7}: django {django_ms:10.1f} ms, '
+                 'leoorm {leoorm_ms:10.1f} ms'.format(**result))
+
+    def clear(self):
+        Book.authors.through.objects.all()._raw_delete('default')
+        Book.objects.all()._raw_delete('default')
+        Author.objects.all()._raw_delete('default')
+
+    def populate_authors(self, n):
+        self.clear()
+        Author.objects.bulk_create([
+            Author(name='author {}'.format(i))
+            for i in range(n)
+        ], batch_size=10000)
+
+    def bench_insert(self, n):
+        async def leoorm(orm):
+            for i in range(n):
+                await orm.save(Author(name='author {}'.format(i)))
+
+        self.compare(
+            'insert', n,
+            lambda: [Author.objects.create(name='author {}'.format(i)) for i in range(n)],
+            leoorm,
+            setup=lambda: Author.objects.all()._raw_delete('default'),
+        )
+
+    def bench_bulk_insert(self, n):
+        async def leoorm(orm):
+            await orm.save([Author(name='author {}'.format(i)) for i in range(n)])
+
+        self.compare(
+            'bulk_insert', n,
+            lambda: Author.objects.bulk_create([
+                Author(name='author {}'.format(i)) for i in range(n)
+            ], batch_size=10000),
+            leoorm,
+            setup=lambda: Author.objects.all()._raw_delete('default'),
+        )
+
+    def bench_update(self, n):
+        self.populate_authors(n)
+        authors = list(Author.objects.all())
+
+        def rename():
+            for author in authors:
+                author.name += '!'
+
+        def dj():
+            rename()
+            Author.objects.bulk_update(authors, ['name'], batch_size=1000)
+
+        async def leoorm(orm):
+            rename()
+            await orm.update(authors, 'name')
+
+        self.compare('update', n, dj, leoorm)
+
+    def bench_get(self, n):
+        self.populate_authors(n)
+        ids = list(Author.objects.values_list('id', flat=True))
+
+        async def leoorm(orm):
+            for pk in ids:
+                await orm.get(Author, id=pk)
+
+        self.compare('get', n, lambda: [Author.objects.get(id=pk) for pk in ids], leoorm)
+
+    def bench_get_list(self, n):
+        self.populate_authors(n)
+
+        async def leoorm(orm):
+            await orm.get_list(Author)
+
+        self.compare('get_list', n, lambda: list(Author.objects.all()), leoorm)
+
+    def bench_count(self, n):
+        self.populate_authors(1000)
+
+        async def leoorm(orm):
+            for _ in range(n):
+                await orm.count(Author)
+
+        self.compare('count', n, lambda: [Author.objects.count() for _ in range(n)], leoorm)
+
+    def bench_prefetch(self, n):
+        self.populate_authors(10)
+        colors = Color.objects.bulk_create([Color(title='color {}'.format(i)) for i in range(10)])
+        books = Book.objects.bulk_create([
+            Book(
+                title='book {}'.format(i),
+                color=colors[i % 10],
+                json_data={'i': i},
+                array_data=[],
+            ) for i in range(n)
+        ])
+        authors = list(Author.objects.all())
+        Book.authors.through.objects.bulk_create([
+            Book.authors.through(book_id=book.id, author_id=authors[i % 10].id)
+            for i, book in enumerate(books)
+        ])
+
+        async def leoorm(orm):
+            await orm.prefetch(await orm.get_list(Book), 'color', 'authors')
+
+        self.compare(
+            'prefetch', n,
+            lambda: list(Book.objects.prefetch_related('color', 'authors')),
+            leoorm,
+        )
+
+    def bench_to_model(self, n):
+        self.populate_authors(n)
+        records = self.loop.run_until_complete(
+            self.orm.get_raw_list('SELECT * FROM {leoorm_test.Author}'))
+        names = list(records[0].keys())
+
+        async def leoorm(orm):
+            [orm.to_model(Author, r) for r in records]
+
+        self.compare(
+            'to_model', n,
+            lambda: [Author.from_db('default', names, tuple(r)) for r in records],
+            leoorm,
+        )
+
+    def bench_concurrent(self, n):
+        """
+        Queries per second for `clients` coroutines sharing the pool.
+        """
+        self.populate_authors(1000)
+        ids = list(Author.objects.values_list('id', flat=True))
+
+        async def client(k):
+            async with self.pool.acquire() as conn:
+                orm = LeoORM(conn)
+                for i in range(k, n, self.clients - 1):
+                    await orm.get(Author, id=ids[i % len(ids)])
+
+        async def run():
+            # one connection is held by self.conn
+            await asyncio.gather(*(client(k) for k in range(self.clients - 1)))
+
+        ms = self.measure(lambda: self.loop.run_until_complete(run()))
+        result = {
+            'scenario': 'concurrent',
+            'size': n,
+            'django_ms': None,
+            'leoorm_ms': ms,
+            'leoorm_qps': n / ms * 1000,
+        }
+        self.results.append(result)
+        self.log('{scenario:>12} {size:>7}: leoorm {leoorm_ms:10.1f} ms, '
+                 '{leoorm_qps:.0f} queries/s'.format(**result))
@@ -0,0 +1,31 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from leoorm_test.bench import Bench
+
+
+class Command(BaseCommand):
+    help = 'LeoORM vs Django ORM benchmarks, results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10,1000,100000')
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--clients', type=int, default=10)
+        parser.add_argument('--output', help='JSON file, stdout by default')
+
+    def handle(self, *args, **options):
+        if options['clients'] < 2:
+            raise CommandError('--clients must be at least 2')
+        bench = Bench(
+            sizes=[int(n) for n in options['sizes'].split(',')],
+            repeat=options['repeat'],
+            clients=options['clients'],
+            log=self.stderr.write,
+        )
+        data = json.dumps(bench.run(), indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(data)
+        else:
+            self.stdout.write(data)